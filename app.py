@@ -1,7 +1,11 @@
-import base64
 import json
 import os.path
+import queue
+import sys
+import threading
+import tkinter
 from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from functools import partial
 from io import BytesIO
 from tkinter import filedialog, messagebox
@@ -9,73 +13,171 @@ from tkinter import filedialog, messagebox
 import customtkinter as cstk
 import pydantic
 from PIL import Image
-from typing_extensions import Optional
+from typing_extensions import Callable, Optional
 
+import dedup
+import folder_index
+import prefetch
+import profiling
+import saver
 import schema
+import search_index
+import stats
+import thumbnail
+import undo
+from blob_store import BlobStore
+
+_ui_calls: queue.SimpleQueue = queue.SimpleQueue()
+"""calls posted by worker threads, run in Tk main loop by `App._drain_ui_calls`"""
+
+
+def post(func: Callable, *args):
+    """
+    run `func(*args)` in Tk main loop, safe to call from any thread.
+    workers must never call Tk themselves, `after` from another thread blocks until the main loop handles it,
+    which hangs for good if the main loop is waiting for that worker
+    """
+    _ui_calls.put((func, args))
 
 
 class Message(cstk.CTkFrame):
     img_max_size = 400
 
+    @profiling.timed('message_frame.init')
     def __init__(self, master, message: schema.Message):
         super().__init__(master)
         self.grid_columnconfigure(3, weight=1)
 
+        self.on_change: Optional[Callable[[], None]] = None
+        """called after content is added or deleted, the role is chosen or an entry or textbox loses focus"""
+
         self.author_name_entry = cstk.CTkEntry(self, placeholder_text='訊息作者名稱')
-        self.author_name_entry.insert(0, message.name)
         self.author_name_entry.grid(column=0, row=0)
-        self.role_option_menu = cstk.CTkOptionMenu(self, values=['user', 'system', 'assistant'])
-        self.role_option_menu.set(message.role)
+        self.author_name_entry.bind('<FocusOut>', self._changed)
+        self.role_option_menu = cstk.CTkOptionMenu(self, values=['user', 'system', 'assistant'],
+                                                   command=self._changed)
         self.role_option_menu.grid(column=1, row=0)
         self.timestamp_entry = cstk.CTkEntry(self, placeholder_text='時間戳')
-        self.timestamp_entry.insert(0, message.timestamp)
         self.timestamp_entry.grid(column=2, row=0)
+        self.timestamp_entry.bind('<FocusOut>', self._changed)
 
         self.content_list: OrderedDict[cstk.CTkButton, cstk.CTkTextbox | cstk.CTkLabel] = OrderedDict()
+        self.image_content_dict: dict[cstk.CTkLabel, schema.ImageContent] = dict()
+        """original image content of every image label, saved as is without re-encoding"""
+        self.image_future_dict: dict[cstk.CTkLabel, Future] = dict()
+        """thumbnails which are still decoding"""
+
+        self.add_content_button = cstk.CTkButton(self, text='新增內容', width=0, command=self.add_content)
+        self.add_image_button = cstk.CTkButton(self, text='新增圖片', width=0, command=self.add_image)
+
+        self.message = message
+        """message shown in this frame, returned by `to_message` as is while nothing is edited"""
+        self.dirty = False
+        """whether content was edited, added or deleted since `message` was shown"""
+
+        self.set_message(message)
+
+    @profiling.timed('message_frame.set_message')
+    def set_message(self, message: schema.Message):
+        """
+        show `message` in this frame, so that a frame can be recycled for another message
+        :param message: message to show
+        :return: None
+        """
+        for button, c in self.content_list.items():
+            c.destroy()
+            button.destroy()
+        self.content_list.clear()
+        for c in self.image_content_dict.values():
+            # thumbnails are cached by hash, image bytes are not needed to show this message again
+            c.release()
+        self.image_content_dict.clear()
+        for future in self.image_future_dict.values():
+            future.cancel()
+        self.image_future_dict.clear()
+
+        self.author_name_entry.delete(0, cstk.END)
+        self.author_name_entry.insert(0, message.name)
+        self.role_option_menu.set(message.role)
+        self.timestamp_entry.delete(0, cstk.END)
+        self.timestamp_entry.insert(0, message.timestamp)
+        self.message = message
 
         if isinstance(message.content, list):
-            for i, c in enumerate(message.content):
-                delete_button = cstk.CTkButton(self, text='X', width=0)
-                delete_button.configure(command=partial(self.delete, delete_button))
-                delete_button.grid(column=4, row=i + 1)
+            for c in message.content:
                 if isinstance(c, schema.TextContent):
-                    textbox = cstk.CTkTextbox(self, height=80)
-                    textbox.insert('1.0', c.text)
-                    textbox.grid(column=0, columnspan=4, row=i + 1, sticky='we')
-                    self.content_list[delete_button] = textbox
+                    self._append_textbox(c.text)
                 elif isinstance(c, schema.ImageContent):
-                    img = Image.open(BytesIO(c.get_image_bytes()))
-                    if max(img.size) > self.img_max_size:
-                        size = ((img.size[0] * self.img_max_size) // max(img.size),
-                                (img.size[1] * self.img_max_size) // max(img.size))
-                    else:
-                        size = img.size
-                    image_label = cstk.CTkLabel(self, text='',
-                                                image=cstk.CTkImage(light_image=img, size=size))
-                    image_label.grid(column=0, columnspan=4, row=i + 1, sticky='we')
-                    self.content_list[delete_button] = image_label
+                    self._append_image_label(c)
         else:
-            delete_button = cstk.CTkButton(self, text='X', width=0)
-            delete_button.configure(command=partial(self.delete, delete_button))
-            delete_button.grid(column=4, row=1)
-            textbox = cstk.CTkTextbox(self, height=80)
-            textbox.insert('1.0', message.content)
-            textbox.grid(column=0, columnspan=4, row=1, sticky='we')
-            self.content_list[delete_button] = textbox
-
-        self.add_content_button = cstk.CTkButton(self, text='新增內容', width=0, command=self.add_content,
-                                                 state=cstk.DISABLED
-                                                 if isinstance(self.content_list[list(self.content_list.keys())[-1]],
-                                                               cstk.CTkTextbox)
-                                                 else cstk.NORMAL)
-        self.add_image_button = cstk.CTkButton(self, text='新增圖片', width=0, command=self.add_image)
-        self.add_content_button.grid(column=0, row=len(self.content_list) + 1)
-        self.add_image_button.grid(column=1, row=len(self.content_list) + 1)
+            self._append_textbox(message.content)
 
-    def add_image(self):
+        self._grid_add_buttons()
+        self.dirty = False
+
+    def _new_delete_button(self) -> cstk.CTkButton:
         delete_button = cstk.CTkButton(self, text='X', width=0)
         delete_button.configure(command=partial(self.delete, delete_button))
         delete_button.grid(column=4, row=len(self.content_list) + 1)
+        return delete_button
+
+    def _append_textbox(self, text: str) -> cstk.CTkTextbox:
+        delete_button = self._new_delete_button()
+        textbox = cstk.CTkTextbox(self, height=80)
+        textbox.insert('1.0', text)
+        textbox.edit_modified(False)
+        textbox.bind('<<Modified>>', partial(self._on_textbox_modified, textbox))
+        textbox.bind('<FocusOut>', self._changed)
+        textbox.grid(column=0, columnspan=4, row=len(self.content_list) + 1, sticky='we')
+        self.content_list[delete_button] = textbox
+        return textbox
+
+    def _append_image_label(self, content: schema.ImageContent) -> cstk.CTkLabel:
+        """
+        add an image label which shows a placeholder until `content` is decoded in `thumbnail.executor`
+        """
+        delete_button = self._new_delete_button()
+        image_label = cstk.CTkLabel(self, text='圖片載入中...', height=80)
+        image_label.grid(column=0, columnspan=4, row=len(self.content_list) + 1, sticky='we')
+        self.content_list[delete_button] = image_label
+        self.image_content_dict[image_label] = content
+
+        future = thumbnail.submit_thumbnail(content, self.img_max_size)
+        self.image_future_dict[image_label] = future
+        future.add_done_callback(partial(self._post_thumbnail, image_label))
+        return image_label
+
+    def _post_thumbnail(self, image_label: cstk.CTkLabel, future: Future):
+        """
+        called in worker thread, hand the thumbnail over to Tk main loop
+        """
+        if not future.cancelled():
+            post(self._show_thumbnail, image_label, future)
+
+    def _show_thumbnail(self, image_label: cstk.CTkLabel, future: Future):
+        if self.image_future_dict.get(image_label) is not future or not image_label.winfo_exists():
+            # label was deleted or recycled before the image was ready
+            return
+        self.image_future_dict.pop(image_label)
+        try:
+            img = future.result()
+        except Exception as e:
+            image_label.configure(text=f'圖片讀取失敗: {e}')
+            return
+        image_label.configure(text='', height=0, image=cstk.CTkImage(light_image=img, size=img.size))
+
+    def _grid_add_buttons(self):
+        self.add_content_button.grid_forget()
+        self.add_image_button.grid_forget()
+        self.add_content_button.grid(column=0, row=len(self.content_list) + 1)
+        self.add_image_button.grid(column=1, row=len(self.content_list) + 1)
+
+        self.add_content_button.configure(state=cstk.DISABLED
+        if len(self.content_list) > 0 and isinstance(self.content_list[next(reversed(self.content_list))],
+                                                     cstk.CTkTextbox)
+        else cstk.NORMAL)
+
+    def add_image(self):
         path = filedialog.askopenfilename(filetypes=[('圖片',
                                                       ('.jpg', '.jpeg', '.png', '.bmp', '.webp')),
                                                      ('所有檔案', '.*')])
@@ -83,33 +185,37 @@ class Message(cstk.CTkFrame):
             return
         try:
             with open(path, 'rb') as f:
-                img = Image.open(BytesIO(f.read()))
+                data = f.read()
+            img = Image.open(BytesIO(data))
+            mime_type = Image.MIME.get(img.format)
+            if mime_type is None:
+                b = BytesIO()
+                img.save(b, format='png')
+                data, mime_type = b.getvalue(), 'image/png'
         except Exception as e:
             messagebox.showerror('讀取失敗!', f'圖片讀取失敗!\n原因: {e}')
-            delete_button.destroy()
-            del delete_button
             return
-        if max(img.size) > self.img_max_size:
-            size = ((img.size[0] * self.img_max_size) // max(img.size),
-                    (img.size[1] * self.img_max_size) // max(img.size))
-        else:
-            size = img.size
-        image_label = cstk.CTkLabel(self, text='',
-                                    image=cstk.CTkImage(light_image=img, size=size))
-        image_label.grid(column=0, columnspan=4, row=len(self.content_list) + 1, sticky='we')
-        self.content_list[delete_button] = image_label
+        self._append_image_label(schema.ImageContent.from_bytes(data, mime_type))
+        self._grid_add_buttons()
+        self.dirty = True
+        self._changed()
 
-        self.add_content_button.grid_forget()
-        self.add_image_button.grid_forget()
-        self.add_content_button.grid(column=0, row=len(self.content_list) + 1)
-        self.add_image_button.grid(column=1, row=len(self.content_list) + 1)
+    def _changed(self, event=None):
+        if self.on_change is not None:
+            self.on_change()
 
-        self.add_content_button.configure(state=cstk.NORMAL)
+    def _on_textbox_modified(self, textbox: cstk.CTkTextbox, event=None):
+        if textbox.edit_modified():
+            self.dirty = True
 
     def delete(self, button: cstk.CTkButton):
         self.content_list[button].destroy()
-        self.content_list.pop(button)
+        c = self.content_list.pop(button)
+        self.image_content_dict.pop(c, None)
+        if c in self.image_future_dict:
+            self.image_future_dict.pop(c).cancel()
         button.destroy()
+        self.dirty = True
 
         if len(self.content_list) == 0:
             self.grid_forget()
@@ -119,42 +225,65 @@ class Message(cstk.CTkFrame):
             if isinstance(self.content_list[list(self.content_list.keys())[-1]],
                           cstk.CTkTextbox)
             else cstk.NORMAL)
+        self._changed()
 
     def add_content(self):
-        delete_button = cstk.CTkButton(self, text='X', width=0)
-        delete_button.configure(command=partial(self.delete, delete_button))
-        delete_button.grid(column=4, row=len(self.content_list) + 1)
-        textbox = cstk.CTkTextbox(self, height=80)
-        textbox.grid(column=0, columnspan=4, row=len(self.content_list) + 1, sticky='we')
-        self.content_list[delete_button] = textbox
-
-        self.add_content_button.grid_forget()
-        self.add_image_button.grid_forget()
-        self.add_content_button.grid(column=0, row=len(self.content_list) + 1)
-        self.add_image_button.grid(column=1, row=len(self.content_list) + 1)
+        self._append_textbox('')
+        self._grid_add_buttons()
+        self.dirty = True
+        self._changed()
 
-        self.add_content_button.configure(state=cstk.DISABLED)
+    def is_edited(self) -> bool:
+        """
+        :return: whether this frame differs from `message`
+        """
+        return (self.dirty or self.author_name_entry.get() != self.message.name
+                or self.role_option_menu.get() != self.message.role
+                or self.timestamp_entry.get() != self.message.timestamp)
 
+    @profiling.timed('to_message')
     def to_message(self) -> Optional[schema.Message]:
+        """
+        build message from this frame, `message` is returned as is if nothing is edited,
+        otherwise the new message replaces `message` and this frame becomes clean again
+        :return: message, None if all content were deleted
+        """
+        if not self.is_edited():
+            return self.message
         content = []
         for c in self.content_list.values():
             if isinstance(c, cstk.CTkTextbox):
                 content.append(schema.TextContent(text=c.get('1.0', cstk.END).strip('\n')))
             elif isinstance(c, cstk.CTkLabel):
-                b = BytesIO()
-                c.cget('image').cget('light_image').convert('RGB').save(b, format='jpeg')
-                content.append(schema.ImageContent(image_url=schema.Image(url='data:image/jpeg;base64,' +
-                                                                              base64.b64encode(b.getvalue()
-                                                                                               ).decode('utf8'))))
+                content.append(self.image_content_dict[c])
         content = content if len(content) > 0 else None
         content = content[0].text if content is not None and \
                                      len(content) == 1 and isinstance(content[0], schema.TextContent) else content
-        return schema.Message(role=self.role_option_menu.get(), timestamp=self.timestamp_entry.get(),
-                              name=self.author_name_entry.get(), content=content) \
-            if content is not None else None
+        if content is None:
+            return None
+
+        self.message = schema.Message(role=self.role_option_menu.get(), timestamp=self.timestamp_entry.get(),
+                                      name=self.author_name_entry.get(), content=content)
+        self.dirty = False
+        for c in self.content_list.values():
+            if isinstance(c, cstk.CTkTextbox):
+                c.edit_modified(False)
+        return self.message
 
 
 class App(cstk.CTk):
+    window_size = 40
+    """how many `Message` frames are alive in `scroll_frame` at the same time"""
+    window_step = 10
+    """how many messages the window moves when scrolling reaches its edge"""
+    window_edge = 0.05
+    prefetch_radius = 2
+    """how many files before and after the current file in the sidebar are prefetched"""
+    ui_poll_ms = 20
+    """how often calls posted by worker threads are run, see `post`"""
+    blob_store_mode = os.environ.get('CONVERSATION_EDITOR_BLOB_STORE', '') not in ('', '0')
+    """save images into `.blobs` folder next to the file instead of inline base64, see `blob_store.BlobStore`"""
+
     def __init__(self):
         super().__init__()
         self.grid_columnconfigure(2, weight=1)
@@ -174,6 +303,47 @@ class App(cstk.CTk):
         self.doc_list_frame.grid(column=0, row=1, columnspan=2, sticky='nesw')
         self.doc_list_frame.grid_columnconfigure(0, weight=1)
         self.doc_list_button_dict: dict[str, cstk.CTkButton] = dict()
+        self.folder_index: Optional[folder_index.FolderIndex] = None
+        self._summary_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='file_summary')
+        """reads message count and preview of sidebar files for their tooltip"""
+        self._doc_hover: Optional[str] = None
+        """path of the sidebar button under the mouse"""
+        self._doc_hover_after_id: Optional[str] = None
+        self._doc_tooltip: Optional[tkinter.Toplevel] = None
+
+        self.search_entry = cstk.CTkEntry(self, placeholder_text='搜尋對話')
+        self.search_entry.grid(column=0, row=2, columnspan=2, sticky='we')
+        self.search_entry.bind('<KeyRelease>', self._on_search_key)
+        self.search_index = search_index.SearchIndex()
+        self._index_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='search_index')
+        """updates `search_index` in background, one task at a time"""
+        self._index_cancelled = threading.Event()
+        """set when the window closes, stops `SearchIndex.sync` between files"""
+        self._search_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='search')
+        """runs searches of `search_index`, which read candidate files again"""
+        self._search_query: Optional[str] = None
+        """normalized query of current search, None if not searching"""
+        self._search_cancelled: Optional[threading.Event] = None
+        """set to drop the search which is running, when a newer one starts"""
+        self._search_hits: Optional[dict[str, Optional[int]]] = None
+        """path -> first matching message of current search if known, None if not searching"""
+        self._hidden_docs: set[str] = set()
+        self._search_after_id: Optional[str] = None
+
+        self.dedup_button = cstk.CTkButton(self, text='尋找重複', command=self.find_duplicates)
+        self.dedup_button.grid(column=0, row=3, columnspan=2, sticky='we')
+        self.stats_button = cstk.CTkButton(self, text='資料集統計', command=self.show_stats)
+        self.stats_button.grid(column=0, row=4, columnspan=2, sticky='we')
+        self._dataset_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='dataset')
+        """runs jobs over the whole folder, duplicate detection and statistics"""
+        self._dataset_cancelled = threading.Event()
+        """set when the window closes, stops jobs of `_dataset_executor` between chunks"""
+        self.stats_window: Optional[cstk.CTkToplevel] = None
+        self.stats_textbox: Optional[cstk.CTkTextbox] = None
+        self._dup_labels: Optional[dict[str, str]] = None
+        """path -> cluster label of duplicate files, only they are shown in sidebar if it is not None"""
+        self._dup_order: dict[str, int] = dict()
+        """path -> cluster number, sidebar buttons are grouped by cluster while showing duplicates"""
 
         self.current_file_label = cstk.CTkLabel(self, text='')
         self.current_file_label.grid(column=2, row=0, sticky='we')
@@ -193,14 +363,14 @@ class App(cstk.CTk):
         self.other_save_button.grid(column=4, row=0)
 
         def f():
+            self.sync_window()
+            self._close_stream()
+            messages = []
+            self.undo_stack.push(undo.ReplaceAll(self.messages, messages, self.current_file_label.cget('text')))
             self.current_file_label.configure(text='')
-            self.add_message_button.grid_forget()
-
-            for m in self.current_message_list:
-                m.destroy()
-            self.current_message_list.clear()
-
-            self.add_message_button.grid(column=0, row=len(self.current_message_list), sticky='we')
+            self.current_file_has_extra = False
+            self.messages = messages
+            self._render_window(0, keep=False)
 
             self.scroll_frame.update_idletasks()
             self.scroll_frame._parent_canvas.yview_moveto(0)
@@ -214,14 +384,7 @@ class App(cstk.CTk):
             if path == '':
                 return
 
-            if self._current_doc_button is not None:
-                try:
-                    self._current_doc_button[0].configure(state=cstk.NORMAL)
-                except Exception:
-                    self._current_doc_button = None
-            if path in self.doc_list_button_dict:
-                self.doc_list_button_dict[path].configure(state=cstk.DISABLED)
-                self._current_doc_button = (self.doc_list_button_dict[path], path)
+            self._select_doc_button(path)
             self.load_history(path)
 
         self.open_file_button = cstk.CTkButton(self, text='開啟檔案', width=0, command=f)
@@ -230,25 +393,22 @@ class App(cstk.CTk):
         def f():
             p = self.current_file_label.cget('text')
             if p != '' and messagebox.askyesno('警告!', f'此操作不可復原，你確定要刪除位於"{p}"的檔案嗎?'):
+                self._close_stream()
                 try:
                     os.remove(p)
                 except Exception as e:
                     messagebox.showerror('錯誤!', f'無法完成刪除操作，錯誤訊息:{e}')
                     return
                 if self._current_doc_button is not None and self._current_doc_button[1] == p:
-                    try:
-                        self._current_doc_button[0].destroy()
-                    finally:
-                        self._current_doc_button = None
-
-                self.add_message_button.grid_forget()
-                for m in self.current_message_list:
-                    m.destroy()
-                self.current_message_list.clear()
+                    self._current_doc_button = None
+                self._update_doc_file(p)
 
-                self.add_message_button.grid(column=0, row=len(self.current_message_list), sticky='we')
+                self.messages = []
+                self.undo_stack.clear()
+                self._render_window(0, keep=False)
 
                 self.current_file_label.configure(text='')
+                self.current_file_has_extra = False
 
                 self.scroll_frame.update_idletasks()
                 self.scroll_frame._parent_canvas.yview_moveto(0)
@@ -258,26 +418,379 @@ class App(cstk.CTk):
         self.delete_current_file_button.grid(column=7, row=0)
 
         self.scroll_frame = cstk.CTkScrollableFrame(self)
-        self.scroll_frame.grid(column=2, row=1, columnspan=6, sticky="nsew")
+        self.scroll_frame.grid(column=2, row=1, rowspan=2, columnspan=6, sticky="nsew")
         self.scroll_frame.grid_columnconfigure(0, weight=1)
+        self.scroll_frame._parent_canvas.configure(yscrollcommand=self._on_scroll)
+        self.scroll_frame._scrollbar.configure(command=self._on_scrollbar)
 
+        self.messages: list[schema.Message] = []
+        """all messages of current file, only those inside the window have a `Message` frame"""
+        self.window_start = 0
         self.current_message_list: list[Message] = []
+        """`Message` frames of `messages[window_start:window_start + len(current_message_list)]`"""
+        self._window_move_pending = False
+        self._scrollbar_target: Optional[int] = None
+        """message the scrollbar was dragged to, shown once Tk is idle"""
+        self.current_file_has_extra = False
+        """whether the current file holds information which `schema.History` drops, checked when loading it"""
+        self.message_stream: Optional[schema.MessageStream] = None
+        """remaining messages of a large file which are read as the user scrolls down"""
+        self._tail_save: Optional[tuple[str, int, str, int]] = None
+        """(path, saved messages, path of `message_stream`, messages it had read) of a save which took over
+        `message_stream`, see `save_history`"""
+        self.undo_stack = undo.UndoStack()
+        """edits of `messages`, recorded by `sync_window`"""
+        self._sync_after_id: Optional[str] = None
 
         self.add_message_button = cstk.CTkButton(self.scroll_frame, text='新增訊息', command=self.add_message)
         self.add_message_button.grid(column=0, row=len(self.current_message_list), sticky='we')
 
         self._current_doc_button: Optional[tuple[cstk.CTkButton, str]] = None
 
+        self.saver = saver.Saver()
+        """writes history files in background"""
+        self.prefetcher = prefetch.Prefetcher(thumbnail_size=Message.img_max_size,
+                                              thumbnail_count=self.window_size)
+        self.save_progress_bar = cstk.CTkProgressBar(self)
+        self.save_progress_bar.grid(column=2, row=3, columnspan=6, sticky='we')
+        self.save_progress_bar.grid_remove()
+        self.protocol('WM_DELETE_WINDOW', self._on_close)
+        self._pending_load: Optional[tuple[str, Optional[int]]] = None
+        """file to open once the save of it is written, see `load_history`"""
+        self._pending_load_after_id: Optional[str] = None
+        self.after(self.ui_poll_ms, self._drain_ui_calls)
+
+        self.profile_enabled = tkinter.BooleanVar(self, value=profiling.enabled)
+        self.debug_menu = tkinter.Menu(self, tearoff=False)
+        self.debug_menu.add_checkbutton(label='啟用計時', variable=self.profile_enabled,
+                                        command=lambda: profiling.set_enabled(self.profile_enabled.get()))
+        self.debug_menu.add_command(label='輸出計時結果...', command=self.dump_profile)
+        self.debug_menu.add_command(label='清除計時結果', command=profiling.reset)
+        self.debug_menu.add_separator()
+        self.debug_menu.add_command(label='剖析下一次開啟檔案...', command=partial(self.capture_profile, 'load_history'))
+        self.debug_menu.add_command(label='剖析下一次存檔...', command=partial(self.capture_profile, 'save_history.write'))
+        self.edit_menu = tkinter.Menu(self, tearoff=False)
+        self.edit_menu.add_command(label='復原', accelerator='Ctrl+Z', command=self.undo)
+        self.edit_menu.add_command(label='重做', accelerator='Ctrl+Y', command=self.redo)
+        self.bind('<Control-z>', lambda e: self.undo())
+        self.bind('<Control-y>', lambda e: self.redo())
+        self.bind('<Control-Z>', lambda e: self.redo())
+        self.menu_bar = tkinter.Menu(self)
+        self.menu_bar.add_cascade(label='編輯', menu=self.edit_menu)
+        self.menu_bar.add_cascade(label='除錯', menu=self.debug_menu)
+        self.configure(menu=self.menu_bar)
+
+    def dump_profile(self):
+        path = filedialog.asksaveasfilename(defaultextension='.txt', filetypes=[('文字文件', '.txt'), ('所有文件', '.*')])
+        if path == '':
+            return
+        try:
+            profiling.dump(path)
+        except OSError as e:
+            messagebox.showerror('錯誤!', f'無法寫入計時結果，錯誤訊息:{e}')
+
+    def capture_profile(self, name: str):
+        """
+        run the next `name` operation under cProfile, see `profiling.capture`
+        :param name: span name of the operation
+        :return: None
+        """
+        path = filedialog.asksaveasfilename(defaultextension='.prof', filetypes=[('cProfile', '.prof'), ('所有文件', '.*')])
+        if path != '':
+            profiling.capture(name, path)
+
+    def _drain_ui_calls(self):
+        while True:
+            try:
+                func, args = _ui_calls.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                func(*args)
+            except Exception:
+                self.report_callback_exception(*sys.exc_info())
+        self.after(self.ui_poll_ms, self._drain_ui_calls)
+
+    def _on_close(self):
+        # indexing is redone on next start, drop it rather than keep the process alive
+        self._index_cancelled.set()
+        self._index_executor.shutdown(wait=False, cancel_futures=True)
+        self._summary_executor.shutdown(wait=False, cancel_futures=True)
+        self._dataset_cancelled.set()
+        self._dataset_executor.shutdown(wait=False, cancel_futures=True)
+        self.prefetcher.shutdown()
+        if self._search_cancelled is not None:
+            self._search_cancelled.set()
+        self._search_executor.shutdown(wait=False, cancel_futures=True)
+        # do not lose a save which is still being written, the main loop keeps running until it is done
+        if self.saver.is_busy():
+            self.withdraw()
+            self.after(self.ui_poll_ms, self._on_close)
+            return
+        self.destroy()
+
     def add_message(self):
         """
         add new message into `scroll_frame`
         :return: None
         """
+        self.sync_window()
+        self.fetch_messages()
+        message = schema.Message(role='user', content='')
+        self.messages.append(message)
+        self.undo_stack.push(undo.MessageInsert(len(self.messages) - 1, message))
+        self._render_window(len(self.messages))
+
+        self.scroll_frame.update_idletasks()
+        self.scroll_frame._parent_canvas.yview_moveto(1)
+
+    def fetch_messages(self, count: Optional[int] = None) -> bool:
+        """
+        read more messages of current file from `message_stream` into `messages`
+        :param count: max number of messages to read, all remaining messages if it is None
+        :return: False if the file turns out to be broken
+        """
+        if self.message_stream is None or (count is not None and count <= 0):
+            return True
+        try:
+            self.messages.extend(self.message_stream.read(count))
+        except (json.JSONDecodeError, pydantic.ValidationError, ValueError, OSError) as e:
+            self._close_stream()
+            messagebox.showerror('錯誤!', f'對話紀錄檔後段讀取失敗，只載入了前{len(self.messages)}則訊息。\n{e}')
+            return False
+        if self.message_stream.done:
+            self.current_file_has_extra = self.message_stream.has_extra
+            self.message_stream = None
+        return True
+
+    def _reopen_tail(self, path: str, skip: int):
+        """
+        stream the rest of current file again after a save took over `message_stream`
+        :param path: file which holds the rest
+        :param skip: number of messages before the rest, they are already in `messages`
+        :return: None
+        """
+        try:
+            stream = schema.MessageStream(path)
+            stream.skip(skip)
+        except (json.JSONDecodeError, ValueError, OSError) as e:
+            # the rest is not loaded, never overwrite it without asking
+            self.current_file_has_extra = True
+            messagebox.showerror('錯誤!', f'對話紀錄檔後段讀取失敗，只載入了前{len(self.messages)}則訊息。\n{e}')
+            return
+        if stream.done:
+            self.current_file_has_extra = stream.has_extra
+        else:
+            self.message_stream = stream
+
+    def _close_stream(self):
+        if self.message_stream is not None:
+            self.message_stream.close()
+            self.message_stream = None
+            # the rest of the file is not loaded, never overwrite it without asking
+            self.current_file_has_extra = True
+
+    def sync_window(self):
+        """
+        write the edits of every frame inside the window back to `messages` and record them into `undo_stack`,
+        messages whose content were all deleted are removed
+        :return: None
+        """
+        self._sync_after_id = None
+        kept = []
+        ops = []
+        for m in self.current_message_list:
+            index = self.window_start + len(kept)
+            old = m.message
+            message = m.to_message()
+            if message is None:
+                ops.append(undo.MessageRemove(index, self.messages.pop(index)))
+                m.destroy()
+            else:
+                self.messages[index] = message
+                if message is not old:
+                    op = undo.diff_message(index, old, message)
+                    if op is not None:
+                        ops.append(op)
+                kept.append(m)
+        self.current_message_list = kept
+        if len(ops) > 0:
+            self.undo_stack.push(ops[0] if len(ops) == 1 else undo.Batch(ops))
+
+    def _on_frame_change(self):
+        # record the edit once the event which caused it is done
+        if self._sync_after_id is None:
+            self._sync_after_id = self.after_idle(self.sync_window)
+
+    def undo(self):
+        self._undo_redo(False)
+
+    def redo(self):
+        self._undo_redo(True)
+
+    def _undo_redo(self, redo: bool):
+        """
+        undo or redo an op of `undo_stack` and show the message it changed
+        :param redo: redo if True, undo otherwise
+        :return: None
+        """
+        if self._sync_after_id is not None:
+            self.after_cancel(self._sync_after_id)
+        # pending edits become the latest op, so undo takes them back first and redo has nothing to do
+        self.sync_window()
+        result = self.undo_stack.redo(self.messages) if redo else self.undo_stack.undo(self.messages)
+        if result is None:
+            return
+        op, self.messages, index = result
+        if isinstance(op, undo.ReplaceAll):
+            self._close_stream()
+            path = op.new_path if redo else op.old_path
+            self.current_file_label.configure(text=path)
+            # the restored messages may be part of a streamed file, ask before overwriting it
+            self.current_file_has_extra = path != ''
+            self._select_doc_button(path)
+
+        # frames still show the messages before this op, rebuild them before `show_message` syncs them back
+        self._render_window(self.window_start if index is None else index - self.window_size // 2, keep=False)
+        if index is not None:
+            self.show_message(index)
+        else:
+            self.scroll_frame.update_idletasks()
+            self.scroll_frame._parent_canvas.yview_moveto(0)
+
+    def _render_window(self, start: int, keep=True):
+        """
+        show `messages[start:start + window_size]` in `scroll_frame`, frames of messages which are still inside
+        the window are kept and frames which leave the window are recycled for the new messages.
+        call `sync_window` first if the frames could be edited
+        :param start: index of the first message in the window, it will be clamped into the valid range
+        :param keep: keep frames of messages which are still inside the window, set it to False when `messages`
+        has been replaced
+        :return: None
+        """
+        start = max(0, min(start, len(self.messages) - self.window_size))
+        end = min(start + self.window_size, len(self.messages))
+
+        old = {self.window_start + i: m for i, m in enumerate(self.current_message_list)}
+        kept = {i: old.pop(i) for i in range(start, end) if i in old} if keep else {}
+        free = list(old.values())
+
         self.add_message_button.grid_forget()
-        self.current_message_list.append(Message(self.scroll_frame, schema.Message(role='user', content='')))
-        self.current_message_list[-1].grid(column=0, row=len(self.current_message_list), sticky='we')
-        self.add_message_button.grid(column=0, row=len(self.current_message_list) + 1, sticky='we')
+        self.current_message_list = []
+        for i in range(start, end):
+            if i in kept:
+                m = kept[i]
+            elif len(free) > 0:
+                m = free.pop()
+                m.set_message(self.messages[i])
+            else:
+                m = Message(self.scroll_frame, self.messages[i])
+                m.on_change = self._on_frame_change
+            m.grid(column=0, row=i - start, sticky='we')
+            self.current_message_list.append(m)
+        for m in free:
+            m.destroy()
+        self.window_start = start
+
+        self.add_message_button.grid(column=0, row=len(self.current_message_list), sticky='we')
+
+    def _scroll_total(self) -> int:
+        """
+        :return: number of messages the scrollbar stands for, unread messages of a streamed file count as a window
+        """
+        return len(self.messages) + (self.window_size if self.message_stream is not None else 0)
+
+    def _on_scroll(self, first: str, last: str):
+        total, n = self._scroll_total(), len(self.current_message_list)
+        if total > 0 and n > 0:
+            # the scrollbar stands for every message of the file rather than the frames inside the window
+            self.scroll_frame._scrollbar.set((self.window_start + float(first) * n) / total,
+                                             (self.window_start + float(last) * n) / total)
+        else:
+            self.scroll_frame._scrollbar.set(first, last)
+        if self._window_move_pending:
+            return
+        if float(last) >= 1 - self.window_edge and (self.window_start + len(self.current_message_list) < len(
+                self.messages) or self.message_stream is not None):
+            self._window_move_pending = True
+            self.after_idle(self._move_window, self.window_step)
+        elif float(first) <= self.window_edge and self.window_start > 0:
+            self._window_move_pending = True
+            self.after_idle(self._move_window, -self.window_step)
+
+    def _on_scrollbar(self, command: str, *args):
+        """
+        command of the scrollbar, a drag jumps to the message at that place of the file, see `show_message`.
+        other scrolling goes to the canvas
+        """
+        total, n = self._scroll_total(), len(self.current_message_list)
+        if command != 'moveto' or total == 0 or n == 0:
+            self.scroll_frame._parent_canvas.yview(command, *args)
+            return
+        position = float(args[0]) * total
+        if self.window_start <= position < self.window_start + n:
+            self.scroll_frame._parent_canvas.yview_moveto((position - self.window_start) / n)
+            return
+        # a drag fires for every mouse motion, only the last target is shown
+        if self._scrollbar_target is None:
+            self.after_idle(self._show_scrollbar_target)
+        self._scrollbar_target = int(position)
+
+    def _show_scrollbar_target(self):
+        index, self._scrollbar_target = self._scrollbar_target, None
+        if index is not None:
+            self.show_message(index)
+
+    def _move_window(self, step: int):
+        """
+        move the window by `step` messages while keeping the visible messages at the same place on screen
+        :param step: positive to move down, negative to move up
+        :return: None
+        """
+        try:
+            self.sync_window()
+            if step > 0:
+                self.fetch_messages(self.window_start + len(self.current_message_list) + step - len(self.messages))
+            canvas = self.scroll_frame._parent_canvas
+            anchor_index = self.window_start + (min(step, len(self.current_message_list) - 1) if step > 0 else 0)
+            anchor = None
+            if 0 <= anchor_index - self.window_start < len(self.current_message_list):
+                anchor = self.current_message_list[anchor_index - self.window_start]
+                offset = anchor.winfo_y() - canvas.canvasy(0)
+
+            self._render_window(self.window_start + step)
+
+            self.scroll_frame.update_idletasks()
+            canvas.configure(scrollregion=canvas.bbox('all'))
+            if anchor is not None and anchor in self.current_message_list:
+                height = self.scroll_frame.winfo_reqheight()
+                if height > 0:
+                    canvas.yview_moveto(max(0.0, anchor.winfo_y() - offset) / height)
+        finally:
+            self._window_move_pending = False
+
+    def show_message(self, index: int):
+        """
+        move the window to `messages[index]` and scroll it into view
+        :param index: index of the message in `messages`
+        :return: None
+        """
+        self.sync_window()
+        self.fetch_messages(index + self.window_size // 2 + 1 - len(self.messages))
+        if len(self.messages) == 0:
+            return
+        index = max(0, min(index, len(self.messages) - 1))
+        self._render_window(index - self.window_size // 2)
 
+        self.scroll_frame.update_idletasks()
+        canvas = self.scroll_frame._parent_canvas
+        canvas.configure(scrollregion=canvas.bbox('all'))
+        m = self.current_message_list[index - self.window_start]
+        height = self.scroll_frame.winfo_reqheight()
+        if height > 0:
+            canvas.yview_moveto(m.winfo_y() / height)
+
+    @profiling.timed('save_history')
     def save_history(self, path: str, ask_again: bool):
         if path == '' and ask_again:
             path = filedialog.asksaveasfilename(defaultextension='.json',
@@ -290,22 +803,69 @@ class App(cstk.CTk):
         if os.path.exists(path):
             pass
 
-        if self.current_file_label.cget('text') != '':
-            with open(self.current_file_label.cget('text'), 'r', encoding='utf8') as f:
-                try:
-                    schema.History.model_validate_json(f.read())
-                except pydantic.ValidationError:
-                    if (self.current_file_label.cget('text') == path and
-                            not messagebox.askyesno('提醒', '原始檔案中存在其他資訊，是否要覆蓋?')):
-                        path = path + '_modify' if path.rfind('.') == -1 \
-                            else path[:path.rfind('.')] + '_modify' + path[path.rfind('.'):]
+        if self._tail_save is not None:
+            # the saver thread still holds the unread rest of the file, save again once it is written
+            self.after(self.ui_poll_ms, self.save_history, path, False)
+            return
 
-        with open(path, 'w', encoding='utf8') as f:
-            f.write(schema.History(history=[m.to_message() for m in self.current_message_list
-                                            if m.to_message() is not None]).model_dump_json(indent=2))
+        if self.current_file_label.cget('text') == path:
+            if self.current_file_has_extra:
+                question = '原始檔案中存在其他資訊，是否要覆蓋?'
+            elif self.message_stream is not None:
+                question = '檔案尚未完全載入，未載入的部分可能存在其他資訊，是否要覆蓋?'
+            else:
+                question = None
+            if question is not None and not messagebox.askyesno('提醒', question):
+                path = path + '_modify' if path.rfind('.') == -1 \
+                    else path[:path.rfind('.')] + '_modify' + path[path.rfind('.'):]
+
+        self.sync_window()
+        self.save_progress_bar.set(0)
+        self.save_progress_bar.grid()
+        # messages of a large file which were not scrolled to yet are still in the file, the saver thread reads
+        # and writes them after the loaded ones, see `_reopen_tail`
+        tail, self.message_stream = self.message_stream, None
+        if tail is not None:
+            self._tail_save = path, len(self.messages), tail.path, tail.count
+        # the messages are immutable, a copy of the list is enough for the saver thread
+        self.saver.submit(path, list(self.messages), BlobStore.for_file(path) if self.blob_store_mode else None,
+                          progress=self._post_save_progress, done=self._post_save_done, tail=tail)
 
         self.current_file_label.configure(text=path)
 
+    def _post_save_progress(self, path: str, i: int, n: int):
+        """
+        called in saver thread, update `save_progress_bar` in Tk main loop
+        """
+        post(self.save_progress_bar.set, i / n if n > 0 else 1)
+
+    def _post_save_done(self, path: str, error: Optional[BaseException]):
+        """
+        called in saver thread, finish the save in Tk main loop
+        """
+        post(self._on_save_done, path, error)
+
+    def _on_save_done(self, path: str, error: Optional[BaseException]):
+        if not self.saver.is_busy():
+            self.save_progress_bar.grid_remove()
+
+        if self._tail_save is not None and self._tail_save[0] == path:
+            saved_path, saved_count, source_path, source_count = self._tail_save
+            self._tail_save = None
+            if self.current_file_label.cget('text') == path:
+                # the file which was written holds the rest after the saved messages, the source is untouched on error
+                if error is None:
+                    self._reopen_tail(saved_path, saved_count)
+                else:
+                    self._reopen_tail(source_path, source_count)
+
+        if error is not None:
+            messagebox.showerror('存檔失敗!', f'無法寫入"{path}"，原檔案未被更動，錯誤訊息:{error}')
+            return
+
+        if self.current_file_label.cget('text') == path:
+            # the file now holds exactly the messages, unless another file was opened meanwhile
+            self.current_file_has_extra = False
         if self.load_entry.get() == '':
             self.load_entry.configure(state=cstk.NORMAL)
             self.load_entry.delete(0, cstk.END)
@@ -313,8 +873,10 @@ class App(cstk.CTk):
             self.load_entry.configure(state=cstk.DISABLED)
             self.load_path(False)
         else:
-            self.load_path(False)
+            self._update_doc_file(path)
+            self._select_doc_button(path)
 
+    @profiling.timed('load_path')
     def load_path(self, ask_folder=True):
         """
         load a folder and add json file button into sidebar
@@ -331,75 +893,404 @@ class App(cstk.CTk):
         self.load_entry.configure(state=cstk.NORMAL)
         self.load_entry.delete(0, cstk.END)
         self.load_entry.insert(0, path)
-        for b in self.doc_list_button_dict.values():
-            b.destroy()
-        self.doc_list_button_dict.clear()
-        for i, p in enumerate(p for p in os.listdir(self.load_entry.get())
-                              if os.path.isfile(os.path.join(self.load_entry.get(), p)) and p.endswith('.json')):
-            path = os.path.join(self.load_entry.get(), p).replace('\\', '/')
-
-            def f(p):
-                if self._current_doc_button is not None:
-                    try:
-                        self._current_doc_button[0].configure(state=cstk.NORMAL)
-                    except Exception:
-                        self._current_doc_button = None
-                self.doc_list_button_dict[p].configure(state=cstk.DISABLED)
-                self._current_doc_button = (self.doc_list_button_dict[p], p)
-                self.load_history(p)
-
-            self.doc_list_button_dict[path] = cstk.CTkButton(self.doc_list_frame, text=p, command=partial(f, path))
-            self.doc_list_button_dict[path].grid(column=0, row=i, sticky='we')
-            self.doc_list_button_dict[path].configure()
         self.load_entry.configure(state=cstk.DISABLED)
 
+        if self.folder_index is None or self.folder_index.folder != path.replace('\\', '/'):
+            for b in self.doc_list_button_dict.values():
+                b.destroy()
+            self.doc_list_button_dict.clear()
+            self._current_doc_button = None
+            self.prefetcher.clear()
+            self._dup_labels = None
+            self._dup_order = dict()
+            self.dedup_button.configure(text='尋找重複')
+            self.folder_index = folder_index.FolderIndex(path)
+        try:
+            added, _, removed = self.folder_index.refresh()
+        except OSError as e:
+            messagebox.showerror('錯誤!', f'無法讀取資料夾，錯誤訊息:{e}')
+            return
+        self._update_doc_list(added, removed)
+        self._index_folder()
+
         if self.current_file_label.cget('text') != '':
-            full_path: str = self.current_file_label.cget('text')
-            path = full_path[:full_path.rfind('/')]
-            if full_path in self.doc_list_button_dict and path == self.load_entry.get():
-                self.doc_list_button_dict[full_path].configure(state=cstk.DISABLED)
-                self._current_doc_button = self.doc_list_button_dict[full_path], full_path
+            self._select_doc_button(self.current_file_label.cget('text'))
+
+    def _update_doc_list(self, added: list[str], removed: list[str]):
+        """
+        add and remove sidebar buttons, buttons of other files are kept as is
+        :param added: paths of new files
+        :param removed: paths of removed files
+        :return: None
+        """
+        def f(p):
+            self._select_doc_button(p)
+            self.load_history(p, None if self._search_hits is None else self._search_hits.get(p))
+
+        for p in removed:
+            if p in self.doc_list_button_dict:
+                self.doc_list_button_dict.pop(p).destroy()
+            if self._doc_hover == p:
+                self._on_doc_leave()
+        for p in added:
+            button = cstk.CTkButton(self.doc_list_frame, text=self._doc_button_text(p), command=partial(f, p))
+            button.bind('<Enter>', partial(self._on_doc_enter, p), add='+')
+            button.bind('<Leave>', self._on_doc_leave, add='+')
+            self.doc_list_button_dict[p] = button
+        if len(added) > 0 or len(removed) > 0:
+            self._grid_doc_list()
+
+    def _on_doc_enter(self, path: str, event=None):
+        """
+        show message count and preview of `path` in a tooltip once the mouse rests on its sidebar button
+        """
+        self._on_doc_leave()
+        self._doc_hover = path
+        self._doc_hover_after_id = self.after(500, self._request_doc_summary, path)
+
+    def _on_doc_leave(self, event=None):
+        self._doc_hover = None
+        if self._doc_hover_after_id is not None:
+            self.after_cancel(self._doc_hover_after_id)
+            self._doc_hover_after_id = None
+        if self._doc_tooltip is not None:
+            self._doc_tooltip.destroy()
+            self._doc_tooltip = None
+
+    def _request_doc_summary(self, path: str):
+        self._doc_hover_after_id = None
+        entry = None if self.folder_index is None else self.folder_index.entries.get(path)
+        if entry is None:
+            return
+        # the summary reads the whole file, which may be large or on a slow disk
+        future = self._summary_executor.submit(lambda: (entry.message_count, entry.preview))
+        future.add_done_callback(partial(self._post_doc_summary, path))
+
+    def _post_doc_summary(self, path: str, future: Future):
+        """
+        called in worker thread, show the tooltip in Tk main loop
+        """
+        if not future.cancelled():
+            post(self._show_doc_tooltip, path, *future.result())
+
+    def _show_doc_tooltip(self, path: str, count: int, preview: str):
+        if self._doc_hover != path or self._doc_tooltip is not None:
+            return
+        self._doc_tooltip = tkinter.Toplevel(self)
+        self._doc_tooltip.wm_overrideredirect(True)
+        self._doc_tooltip.wm_geometry(f'+{self.winfo_pointerx() + 12}+{self.winfo_pointery() + 12}')
+        text = f'{count} 則訊息' if preview == '' else f'{count} 則訊息\n{preview}'
+        tkinter.Label(self._doc_tooltip, text=text, justify=tkinter.LEFT, relief=tkinter.SOLID, borderwidth=1,
+                      wraplength=400).pack()
+
+    def _doc_button_text(self, path: str) -> str:
+        name = path[path.rfind('/') + 1:]
+        if self._dup_labels is not None and path in self._dup_labels:
+            return f'{self._dup_labels[path]} {name}'
+        return name
+
+    def _doc_order(self) -> list[str]:
+        """
+        :return: paths of sidebar buttons from top to bottom, hidden ones included
+        """
+        paths = self.folder_index.paths()
+        if self._dup_labels is not None:
+            paths.sort(key=lambda p: self._dup_order.get(p, 0))
+        return paths
+
+    def _grid_doc_list(self):
+        for i, p in enumerate(self._doc_order()):
+            self.doc_list_button_dict[p].grid(column=0, row=i, sticky='we')
+        self._hidden_docs.clear()
+        self._filter_doc_list()
+
+    def _update_doc_file(self, path: str):
+        """
+        update sidebar after `path` is written or deleted, without rescanning the folder
+        :param path: path of the file
+        :return: None
+        """
+        if self.folder_index is None:
+            return
+        path = path.replace('\\', '/')
+        status = self.folder_index.update_file(path)
+        if status == 'added':
+            self._update_doc_list([path], [])
+        elif status == 'removed':
+            self._update_doc_list([], [path])
+
+        if status in ('added', 'changed'):
+            future = self._index_executor.submit(self.search_index.add_file, path,
+                                                 self.folder_index.entries[path].mtime_ns)
+            future.add_done_callback(self._post_search_index_update)
+        elif status == 'removed':
+            future = self._index_executor.submit(self.search_index.remove_file, path)
+            future.add_done_callback(self._post_search_index_update)
+
+    def _index_folder(self):
+        """
+        bring `search_index` up to date with `folder_index` in background
+        :return: None
+        """
+        future = self._index_executor.submit(self.search_index.sync, dict(self.folder_index.entries),
+                                              self._index_cancelled)
+        future.add_done_callback(self._post_search_index_update)
+
+    def _post_search_index_update(self, future: Future):
+        """
+        called in worker thread, search again in Tk main loop if the user is searching
+        """
+        if self._search_query is not None:
+            post(self.search)
+
+    def _on_search_key(self, event=None):
+        if self._search_after_id is not None:
+            self.after_cancel(self._search_after_id)
+        self._search_after_id = self.after(150, self.search)
+
+    def search(self):
+        """
+        search `search_entry` in background and show only sidebar buttons of files which match,
+        all buttons are shown if it is empty
+        :return: None
+        """
+        self._search_after_id = None
+        if self._search_cancelled is not None:
+            self._search_cancelled.set()
+            self._search_cancelled = None
+        query = search_index.normalize(self.search_entry.get())
+        if query == '':
+            self._search_query = None
+            self._search_hits = None
+            self._filter_doc_list()
+            return
+        self._search_query = query
+        cancelled = self._search_cancelled = threading.Event()
+        future = self._search_executor.submit(self.search_index.search, query, cancelled)
+        future.add_done_callback(partial(post, self._on_search_done, cancelled))
+
+    def _on_search_done(self, cancelled: threading.Event, future: Future):
+        if cancelled.is_set():
+            # a newer search was started
+            return
+        self._search_cancelled = None
+        self._search_hits = future.result()
+        self._filter_doc_list()
+
+    def _filter_doc_list(self):
+        for p, b in self.doc_list_button_dict.items():
+            hidden = ((self._search_hits is not None and p not in self._search_hits) or
+                      (self._dup_labels is not None and p not in self._dup_labels))
+            if hidden and p not in self._hidden_docs:
+                b.grid_remove()
+                self._hidden_docs.add(p)
+            elif not hidden and p in self._hidden_docs:
+                b.grid()
+                self._hidden_docs.discard(p)
+
+    def find_duplicates(self):
+        """
+        find duplicate files of current folder in background and show only them in sidebar grouped by cluster,
+        or show every file again if duplicates are being shown
+        :return: None
+        """
+        if self._dup_labels is not None:
+            self._show_duplicates(None)
+            return
+        if self.folder_index is None or len(self.folder_index.entries) == 0:
+            return
+        self.dedup_button.configure(state=cstk.DISABLED, text='比對中...')
+        folder = self.folder_index.folder
+        future = self._dataset_executor.submit(dedup.build_index, self.folder_index.paths(), os.cpu_count() or 1,
+                                                self._dataset_cancelled)
+
+        future.add_done_callback(partial(post, self._on_duplicates_found, folder))
+
+    def _on_duplicates_found(self, folder: str, future: Future):
+        self.dedup_button.configure(state=cstk.NORMAL, text='尋找重複')
+        if self.folder_index is None or self.folder_index.folder != folder:
+            # another folder was loaded while comparing
+            return
+        try:
+            index, _ = future.result()
+        except Exception as e:
+            messagebox.showerror('錯誤!', f'無法完成比對，錯誤訊息:{e}')
+            return
+        clusters = index.clusters()
+        if len(clusters) == 0:
+            messagebox.showinfo('尋找重複', '沒有找到重複的對話')
+            return
+        self._show_duplicates(clusters)
+
+    def _show_duplicates(self, clusters: Optional[list[tuple[bool, list[str]]]]):
+        """
+        :param clusters: clusters of `dedup.DedupIndex.clusters`, every file is shown again if it is None
+        :return: None
+        """
+        if clusters is None:
+            self._dup_labels = None
+            self._dup_order = dict()
+            self.dedup_button.configure(text='尋找重複')
+        else:
+            # `=` marks exact duplicates, `≈` near-duplicates
+            self._dup_labels = {p: f'[{n}{"=" if exact else "≈"}]'
+                                for n, (exact, paths) in enumerate(clusters, 1) for p in paths}
+            self._dup_order = {p: n for n, (_, paths) in enumerate(clusters, 1) for p in paths}
+            self.dedup_button.configure(text=f'顯示全部 ({len(clusters)}組重複)')
+        for p, b in self.doc_list_button_dict.items():
+            b.configure(text=self._doc_button_text(p))
+        self._grid_doc_list()
+
+    def show_stats(self):
+        """
+        open stats window and compute statistics of current folder in background
+        :return: None
+        """
+        if self.folder_index is None or len(self.folder_index.entries) == 0:
+            return
+        if self.stats_window is None or not self.stats_window.winfo_exists():
+            self.stats_window = cstk.CTkToplevel(self)
+            self.stats_window.title('資料集統計')
+            self.stats_window.geometry('500x600')
+            self.stats_textbox = cstk.CTkTextbox(self.stats_window)
+            self.stats_textbox.pack(fill='both', expand=True)
+        else:
+            self.stats_window.focus()
+        self.stats_button.configure(state=cstk.DISABLED)
+        self._set_stats_text(f'計算中...\n{self.folder_index.folder}')
+
+        folder = self.folder_index.folder
 
-    def load_history(self, file_path: str):
+        def progress(done: int, total: int):
+            post(self._set_stats_text, f'計算中... {done}/{total}\n{folder}')
+
+        def compute(paths: list[str]) -> tuple[dict, list[tuple[str, str]]]:
+            features = stats.collect_features(paths, os.cpu_count() or 1, progress=progress,
+                                              cancelled=self._dataset_cancelled)
+            return stats.compute_stats(features), features.errors
+
+        future = self._dataset_executor.submit(compute, self.folder_index.paths())
+        future.add_done_callback(partial(post, self._on_stats_computed, folder))
+
+    def _set_stats_text(self, text: str):
+        if self.stats_window is None or not self.stats_window.winfo_exists():
+            return
+        self.stats_textbox.configure(state=cstk.NORMAL)
+        self.stats_textbox.delete('1.0', cstk.END)
+        self.stats_textbox.insert('1.0', text)
+        self.stats_textbox.configure(state=cstk.DISABLED)
+
+    def _on_stats_computed(self, folder: str, future: Future):
+        self.stats_button.configure(state=cstk.NORMAL)
+        try:
+            result, errors = future.result()
+        except Exception as e:
+            self._set_stats_text(f'無法完成統計，錯誤訊息:{e}')
+            return
+        text = f'{folder}\n\n{stats.format_stats(result)}'
+        if len(errors) > 0:
+            text += '\n\n無法讀取的檔案:\n' + '\n'.join(f'{p}: {e}' for p, e in errors)
+        self._set_stats_text(text)
+
+    def _select_doc_button(self, path: str):
+        """
+        disable sidebar button of `path` to mark it as current file, and enable the previous one
+        :param path: path of current file
+        :return: None
+        """
+        if self._current_doc_button is not None:
+            try:
+                self._current_doc_button[0].configure(state=cstk.NORMAL)
+            except Exception:
+                pass
+            self._current_doc_button = None
+        if path in self.doc_list_button_dict:
+            self.doc_list_button_dict[path].configure(state=cstk.DISABLED)
+            self._current_doc_button = (self.doc_list_button_dict[path], path)
+
+    @profiling.timed('load_history')
+    def load_history(self, file_path: str, show_index: Optional[int] = None):
         """
         load `file_path` json file to `scroll_frame`
         :param file_path: which json file to load
+        :param show_index: index of the message to show, the first message if it is None
         :return: None
         """
+        # a save of this file may still be in progress, open it once the save is written without blocking the main
+        # loop, the saver posts its callbacks into the main loop
+        if self.saver.is_busy(file_path):
+            self._pending_load = file_path, show_index
+            if self._pending_load_after_id is None:
+                self._pending_load_after_id = self.after(self.ui_poll_ms, self._load_pending)
+            return
+        self._pending_load = None
+        prefetched = self.prefetcher.take(file_path)
+        stream = None
         try:
-            with open(file_path, 'r', encoding='utf8') as f:
-                obj: dict = json.loads(f.read())
-
-            if isinstance(obj, list):
-                history = schema.History(history=obj)
+            if prefetched is not None:
+                messages, has_extra = prefetched
+            elif os.path.getsize(file_path) > schema.STREAM_THRESHOLD:
+                # only parse the first page of a large file, the rest is read as the user scrolls down
+                with profiling.span('load_history.stream'):
+                    stream = schema.MessageStream(file_path)
+                    messages = stream.read(self.window_size)
+                has_extra = stream.has_extra
             else:
-                history = schema.History(**obj)
-        except json.JSONDecodeError as e:
+                with profiling.span('load_history.read_json'):
+                    obj = schema.read_json_file(file_path)
+                with profiling.span('load_history.validate'):
+                    messages = schema.parse_history(obj, BlobStore.for_file(file_path)).history
+                has_extra = schema.has_extra_fields(obj)
+        except (json.JSONDecodeError, pydantic.ValidationError, ValueError) as e:
+            if stream is not None:
+                stream.close()
             messagebox.showerror('錯誤!', f'這不是一個合法的對話紀錄檔。\n{e}')
             return
-        except pydantic.ValidationError:
-            obj['history'] = obj.get('messages')
-            try:
-                history = schema.History.model_validate(obj)
-            except pydantic.ValidationError as e:
-                messagebox.showerror('錯誤!', f'這不是一個合法的對話紀錄檔。\n{e}')
-                return
 
-        self.add_message_button.grid_forget()
-        for m in self.current_message_list:
-            m.destroy()
-        self.current_message_list.clear()
+        self._close_stream()
+        if stream is not None and not stream.done:
+            self.message_stream = stream
+        self.messages = messages
+        self.undo_stack.clear()
+        self.current_file_has_extra = has_extra
+        with profiling.span('load_history.render'):
+            self._render_window(0, keep=False)
 
-        for i, m in enumerate(history.history):
-            self.current_message_list.append(Message(self.scroll_frame, m))
-            self.current_message_list[-1].grid(column=0, row=i, sticky='we')
+            self.current_file_label.configure(text=file_path)
 
-        self.current_file_label.configure(text=file_path)
+            self.scroll_frame.update_idletasks()
+        self.scroll_frame._parent_canvas.yview_moveto(0)
+        if show_index is not None:
+            self.show_message(show_index)
 
-        self.add_message_button.grid(column=0, row=len(self.current_message_list), sticky='we')
+        self._prefetch_neighbours(file_path)
 
-        self.scroll_frame.update_idletasks()
-        self.scroll_frame._parent_canvas.yview_moveto(0)
+    def _load_pending(self):
+        self._pending_load_after_id = None
+        if self._pending_load is not None:
+            self.load_history(*self._pending_load)
+
+    def _prefetch_neighbours(self, path: str):
+        """
+        prefetch files around `path` among the shown sidebar buttons, the nearest first
+        :param path: path of current file
+        :return: None
+        """
+        if self.folder_index is None:
+            return
+        path = path.replace('\\', '/')
+        paths = [p for p in self._doc_order() if p not in self._hidden_docs]
+        try:
+            i = paths.index(path)
+        except ValueError:
+            return
+        neighbours = []
+        for d in range(1, self.prefetch_radius + 1):
+            if i + d < len(paths):
+                neighbours.append(paths[i + d])
+            if i - d >= 0:
+                neighbours.append(paths[i - d])
+        self.prefetcher.prefetch(neighbours)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,187 @@
+"""
+headless benchmarks of the hot paths on synthetic histories, run it with `python -m bench`
+"""
+import argparse
+import gc
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+import PIL
+import PIL.Image
+import pydantic
+from typing_extensions import Any, Callable, Optional
+
+import saver
+import schema
+
+WORDS = ['the', 'of', 'model', 'image', 'conversation', 'data', 'train', 'editor', 'hello', 'world',
+         '你好', '對話', '圖片', '資料', '模型', '訓練', '編輯器', '測試', '，', '。']
+
+
+def generate_image(rng: random.Random, size: int) -> bytes:
+    """
+    :param rng: random source
+    :param size: width and height of the image
+    :return: jpeg bytes of a noise image, noise keeps the encoded size close to a photo of the same size
+    """
+    img = PIL.Image.frombytes('RGB', (size, size), rng.randbytes(size * size * 3))
+    buffer = io.BytesIO()
+    img.save(buffer, format='JPEG', quality=85)
+    return buffer.getvalue()
+
+
+def generate_history(messages: int, text_length: int, images: int, image_size: int, seed=0) -> dict:
+    """
+    build a synthetic history json object, roles alternate between user and assistant after a system message
+    :param messages: number of messages
+    :param text_length: approximate number of characters of each message
+    :param images: number of images, spread over random user messages
+    :param image_size: width and height of each image
+    :param seed: seed of the generator, the same arguments always give the same history
+    :return: `{"history": [...]}` json object
+    """
+    rng = random.Random(seed)
+    user_indices = [i for i in range(messages) if i % 2 == 1] or list(range(messages))
+    image_count = [0] * messages
+    for _ in range(images if messages > 0 else 0):
+        image_count[rng.choice(user_indices)] += 1
+
+    history = []
+    for i in range(messages):
+        role = 'system' if i == 0 else ('user' if i % 2 == 1 else 'assistant')
+        words, length = [], 0
+        while length < text_length:
+            w = rng.choice(WORDS)
+            words.append(w)
+            length += len(w) + 1
+        text = ' '.join(words)
+        if image_count[i] == 0:
+            content = text
+        else:
+            content = [{'type': 'text', 'text': text}]
+            for _ in range(image_count[i]):
+                content.append(schema.ImageContent.from_bytes(generate_image(rng, image_size), 'image/jpeg')
+                               .model_dump())
+        history.append({'role': role, 'content': content, 'name': role,
+                        'timestamp': f'2024-01-01_00-{i // 60 % 60:02d}-{i % 60:02d}'})
+    return {'history': history}
+
+
+def measure(func: Callable[[Any], Any], setup: Optional[Callable[[], Any]] = None, repeat=5) -> dict:
+    """
+    time `func` like `timeit`, with garbage collection disabled while it runs
+    :param func: function to time, called with the return value of `setup`
+    :param setup: called before every run and not timed, so each run gets fresh objects without warm caches
+    :param repeat: number of runs
+    :return: min, median and mean seconds of the runs
+    """
+    times = []
+    for _ in range(repeat):
+        arg = setup() if setup is not None else None
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            func(arg)
+            times.append(time.perf_counter() - start)
+        finally:
+            if gc_enabled:
+                gc.enable()
+    return {'min': min(times), 'median': statistics.median(times), 'mean': statistics.fmean(times),
+            'repeat': repeat}
+
+
+def run(messages: int, text_length: int, images: int, image_size: int, repeat=5, seed=0,
+        window_size=40) -> dict:
+    """
+    run every benchmark on one synthetic history
+    :param window_size: number of messages of the first page read from a `schema.MessageStream`,
+    the same as `app.App.window_size`
+    :return: json object of the results
+    """
+    obj = generate_history(messages, text_length, images, image_size, seed)
+    raw = json.dumps(obj, ensure_ascii=False)
+
+    def fresh_history() -> schema.History:
+        return schema.History.model_validate(obj)
+
+    results = dict()
+    results['parse_json'] = measure(lambda _: schema.json_loads(raw), repeat=repeat)
+    results['history_validate'] = measure(lambda _: schema.History.model_validate(obj), repeat=repeat)
+    results['model_dump_json'] = measure(lambda h: h.model_dump_json(indent=2), fresh_history, repeat)
+    results['write_history_json'] = measure(lambda h: schema.write_history_json(h.history, io.StringIO()),
+                                            fresh_history, repeat)
+    history = fresh_history()
+    # the second save of unchanged messages only joins their cached json
+    schema.write_history_json(history.history, io.StringIO())
+    results['write_history_json_cached'] = measure(lambda _: schema.write_history_json(history.history,
+                                                                                       io.StringIO()),
+                                                   repeat=repeat)
+    results['history_to_ShareGPT'] = measure(lambda h: schema.history_to_ShareGPT(h, is_image=True),
+                                             fresh_history, repeat)
+    results['history_to_ShareGPT_text'] = measure(lambda h: schema.history_to_ShareGPT(h, is_image=False),
+                                                  fresh_history, repeat)
+    results['get_format_content'] = measure(lambda _: [m.get_format_content() for m in history.history],
+                                            repeat=repeat)
+
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'history.json')
+        with open(path, 'w', encoding='utf8') as f:
+            schema.write_history_json(history.history, f)
+        file_size = os.path.getsize(path)
+
+        # headless `App.load_history` and `App.save_history`
+        results['load_history'] = measure(lambda _: schema.load_history_file(path), repeat=repeat)
+
+        def first_page(_):
+            with schema.MessageStream(path) as stream:
+                stream.read(window_size)
+
+        results['load_history_stream_first_page'] = measure(first_page, repeat=repeat)
+        save_path = os.path.join(folder, 'saved.json')
+        results['save_history'] = measure(lambda h: saver.write_history_atomic(save_path, h.history),
+                                          fresh_history, repeat)
+
+    return {
+        'config': {'messages': messages, 'text_length': text_length, 'images': images, 'image_size': image_size,
+                   'repeat': repeat, 'seed': seed, 'file_size': file_size},
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'pydantic': pydantic.VERSION, 'pillow': PIL.__version__,
+                        'json_loads': f'{schema.json_loads.__module__}.{schema.json_loads.__name__}'},
+        'results': results,
+    }
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m bench',
+                                     description='benchmark the hot paths on a synthetic history, '
+                                                 'results are printed as json')
+    parser.add_argument('-m', '--messages', type=int, default=1000, help='number of messages')
+    parser.add_argument('-t', '--text-length', type=int, default=500, help='characters of each message')
+    parser.add_argument('-i', '--images', type=int, default=20, help='number of images')
+    parser.add_argument('-s', '--image-size', type=int, default=512, help='width and height of each image')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='runs of each benchmark')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic history')
+    parser.add_argument('-o', '--output', default=None, help='json file to write results into, default stdout')
+    args = parser.parse_args(argv)
+
+    result = run(args.messages, args.text_length, args.images, args.image_size, args.repeat, args.seed)
+    text = json.dumps(result, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w', encoding='utf8') as f:
+            f.write(text)
+            f.write('\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,77 @@
+import hashlib
+import os
+import re
+
+_digest_pattern = re.compile(r'[0-9a-f]{64}')
+
+
+class BlobStore:
+    """
+    content-addressed store of image bytes, blob `<digest>` is the file `<root>/<digest[:2]>/<digest>`
+    where digest is the sha256 hex digest of the bytes
+    """
+
+    folder_name = '.blobs'
+
+    def __init__(self, root: str):
+        self.root = root.replace('\\', '/')
+
+    @classmethod
+    def for_file(cls, path: str) -> 'BlobStore':
+        """
+        :param path: path of a history file
+        :return: store in the `.blobs` folder next to `path`
+        """
+        path = path.replace('\\', '/')
+        return cls(os.path.join(path[:path.rfind('/')] if '/' in path else '.', cls.folder_name))
+
+    @staticmethod
+    def digest(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    @staticmethod
+    def check_digest(digest: str) -> str:
+        """
+        :param digest: digest from an untrusted source, e.g. a blob url of a history file
+        :return: `digest`
+        :raise ValueError: if `digest` is not a sha256 hex digest, so it can never escape the store as a path
+        """
+        if not isinstance(digest, str) or _digest_pattern.fullmatch(digest) is None:
+            raise ValueError(f'invalid blob digest: {digest!r}')
+        return digest
+
+    def path(self, digest: str) -> str:
+        """
+        :raise ValueError: if `digest` is not a sha256 hex digest
+        """
+        self.check_digest(digest)
+        return f'{self.root}/{digest[:2]}/{digest}'
+
+    def __contains__(self, digest: str) -> bool:
+        return _digest_pattern.fullmatch(digest) is not None and os.path.exists(self.path(digest))
+
+    def put(self, data: bytes) -> str:
+        """
+        store `data`, nothing is written if it is already stored
+        :param data: blob bytes
+        :return: digest of `data`
+        """
+        digest = self.digest(data)
+        path = self.path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        return digest
+
+    def get(self, digest: str) -> bytes:
+        """
+        :param digest: digest of the blob
+        :return: blob bytes
+        :raise FileNotFoundError: if the blob is not stored
+        :raise ValueError: if `digest` is not a sha256 hex digest
+        """
+        with open(self.path(digest), 'rb') as f:
+            return f.read()
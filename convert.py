@@ -0,0 +1,125 @@
+"""
+headless batch converter for history files, run it with `python -m convert`
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from functools import partial
+
+from typing_extensions import Optional
+
+import process_pool
+import saver
+import schema
+from blob_store import BlobStore
+
+
+def common_folder(paths: list[str]) -> str:
+    """
+    :param paths: paths of files
+    :return: absolute path of the deepest folder which holds every file
+    """
+    return os.path.commonpath([os.path.dirname(os.path.abspath(p)) for p in paths])
+
+
+def convert_file(path: str, output_format: str, output_dir: Optional[str], image_dir: Optional[str],
+                 blob_store=False, input_root: Optional[str] = None
+                 ) -> tuple[str, Optional[str], int, int, Optional[str]]:
+    """
+    convert one history file, run in worker processes
+    :param path: path of the history file
+    :param output_format: `sharegpt` or `history`
+    :param output_dir: folder of normalized history files, used by `history` format
+    :param image_dir: folder to write images into, used by `sharegpt` format, images are skipped if it is None
+    :param blob_store: write images of `history` format into the `.blobs` folder next to the output file
+    instead of inline
+    :param input_root: the output file of `history` format keeps its path relative to this folder under
+    `output_dir`, so files of the same name in different folders do not overwrite each other.
+    the folder of `path` if it is None, see `common_folder`
+    :return: path, ShareGPT json line (None for `history` format), message count, file size and error message
+    """
+    try:
+        size = os.path.getsize(path)
+        history = schema.load_history_file(path)
+        if output_format == 'sharegpt':
+            image = None if image_dir is None else partial(schema.write_image_file, image_dir=image_dir)
+            line = json.dumps(schema.history_to_ShareGPT_record(history, image), ensure_ascii=False)
+        else:
+            line = None
+            root = os.path.dirname(os.path.abspath(path)) if input_root is None else input_root
+            output_path = os.path.join(output_dir, os.path.relpath(os.path.abspath(path), root))
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            saver.write_history_atomic(output_path, history.history,
+                                       BlobStore.for_file(output_path) if blob_store else None)
+        return path, line, len(history.history), size, None
+    except Exception as e:
+        return path, None, 0, 0, f'{e.__class__.__name__}: {e}'
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m convert',
+                                     description='normalize history files or convert them into ShareGPT jsonl')
+    parser.add_argument('inputs', nargs='+', help='folders or glob patterns of history json files')
+    parser.add_argument('-f', '--format', choices=['sharegpt', 'history'], default='sharegpt',
+                        help='sharegpt: one jsonl file, history: normalized {"history": [...]} json files')
+    parser.add_argument('-o', '--output', required=True,
+                        help='jsonl file for sharegpt format, folder for history format')
+    parser.add_argument('--images', default=None,
+                        help='folder to write images into for sharegpt format, images are skipped if not given')
+    parser.add_argument('--blob-store', action='store_true',
+                        help='history format only, write images into the .blobs folder of the output folder '
+                             'instead of inline base64')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count() or 1,
+                        help='number of worker processes, 0 converts in this process')
+    args = parser.parse_args(argv)
+
+    paths = schema.collect_paths(args.inputs)
+    if len(paths) == 0:
+        print('No history file found.', file=sys.stderr)
+        return 1
+
+    if args.format == 'history':
+        os.makedirs(args.output, exist_ok=True)
+    if args.images is not None:
+        os.makedirs(args.images, exist_ok=True)
+    func = partial(convert_file, output_format=args.format,
+                   output_dir=args.output if args.format == 'history' else None, image_dir=args.images,
+                   blob_store=args.blob_store, input_root=common_folder(paths))
+
+    start = time.perf_counter()
+    done = failed = messages = size = 0
+    executor = process_pool.create(args.workers)
+    out = open(args.output, 'w', encoding='utf8') if args.format == 'sharegpt' else None
+    try:
+        if executor is None:
+            results = map(func, paths)
+        else:
+            results = executor.map(func, paths, chunksize=max(1, min(64, len(paths) // (args.workers * 4))))
+        for path, line, count, file_size, error in results:
+            if error is not None:
+                failed += 1
+                print(f'{path}: {error}', file=sys.stderr)
+                continue
+            done += 1
+            messages += count
+            size += file_size
+            if out is not None:
+                out.write(line)
+                out.write('\n')
+    finally:
+        if out is not None:
+            out.close()
+        if executor is not None:
+            executor.shutdown()
+
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    print(f'{done} converted, {failed} failed in {elapsed:.2f}s: '
+          f'{done / elapsed:.1f} files/s, {messages / elapsed:.1f} messages/s, '
+          f'{size / elapsed / 1024 / 1024:.2f} MiB/s', file=sys.stderr)
+    return 0 if failed == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,282 @@
+"""
+exact and near-duplicate detection of history files, run it with `python -m dedup`.
+exact duplicates share a sha256 fingerprint, near-duplicates are found by MinHash signatures and LSH buckets
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+import unicodedata
+from concurrent.futures import CancelledError
+
+import numpy as np
+from typing_extensions import Iterable, Optional
+
+import process_pool
+import schema
+
+SHINGLE_SIZE = 5
+"""characters of each shingle"""
+NUM_PERM = 64
+"""length of MinHash signatures"""
+LSH_RECALL = 0.95
+"""min probability that a pair of files whose similarity is exactly the threshold share an LSH band, see `lsh_params`"""
+
+_rng = np.random.default_rng(0x5eed)
+_perm_a = _rng.integers(1, 1 << 63, NUM_PERM, dtype=np.uint64) | np.uint64(1)
+_perm_b = _rng.integers(0, 1 << 63, NUM_PERM, dtype=np.uint64)
+"""multiply-shift hash functions, fixed so signatures of different processes and runs are comparable"""
+
+
+def normalize_text(text: str) -> str:
+    """
+    :return: NFKC normalized `text` with whitespace collapsed
+    """
+    return ' '.join(unicodedata.normalize('NFKC', text).split())
+
+
+def _image_hashes(m: schema.Message) -> list[str]:
+    if isinstance(m.content, str):
+        return []
+    return [c.get_hash() for c in m.content if isinstance(c, schema.ImageContent)]
+
+
+def fingerprint(messages: Iterable[schema.Message]) -> str:
+    """
+    fingerprint of role, name, normalized text and image bytes of every message, timestamps are ignored
+    :param messages: messages of a history
+    :return: sha256 hex digest
+    """
+    h = hashlib.sha256()
+    for m in messages:
+        h.update(m.role.encode('utf8'))
+        h.update(b'\0')
+        h.update((m.name or '').encode('utf8'))
+        h.update(b'\0')
+        h.update(normalize_text(m.get_text_content()).encode('utf8'))
+        for image_hash in _image_hashes(m):
+            h.update(b'\0')
+            h.update(image_hash.encode('ascii'))
+        h.update(b'\1')
+    return h.hexdigest()
+
+
+def shingle_hashes(messages: Iterable[schema.Message]) -> np.ndarray:
+    """
+    64 bits hashes of lowercase character shingles of the whole history, images are single tokens
+    :param messages: messages of a history
+    :return: unique shingle hashes
+    """
+    texts, images = [], []
+    for m in messages:
+        texts.append(f'{m.role}: {normalize_text(m.get_text_content()).lower()}')
+        images.extend(int(h[:16], 16) for h in _image_hashes(m))
+    text = '\n'.join(texts)
+    codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+    if len(codes) >= SHINGLE_SIZE:
+        n = len(codes) - SHINGLE_SIZE + 1
+        hashes = np.zeros(n, dtype=np.uint64)
+        # polynomial rolling hash, wraps around at 2^64
+        for j in range(SHINGLE_SIZE):
+            hashes = hashes * np.uint64(1099511628211) + codes[j:j + n]
+    else:
+        hashes = np.array([int(hashlib.sha256(text.encode('utf8')).hexdigest()[:16], 16)] if len(text) > 0 else [],
+                          dtype=np.uint64)
+    if len(images) > 0:
+        hashes = np.concatenate([hashes, np.array(images, dtype=np.uint64)])
+    return np.unique(hashes)
+
+
+def minhash(hashes: np.ndarray, chunk_size=4096) -> np.ndarray:
+    """
+    :param hashes: shingle hashes, see `shingle_hashes`
+    :param chunk_size: shingles hashed at once, bounds the temporary `NUM_PERM`x`chunk_size` array
+    :return: MinHash signature of `NUM_PERM` uint32, all max values for an empty history
+    """
+    signature = np.full(NUM_PERM, np.iinfo(np.uint32).max, dtype=np.uint32)
+    for start in range(0, len(hashes), chunk_size):
+        chunk = hashes[start:start + chunk_size]
+        values = (_perm_a[:, None] * chunk[None, :] + _perm_b[:, None]) >> np.uint64(32)
+        np.minimum(signature, values.min(axis=1).astype(np.uint32), out=signature)
+    return signature
+
+
+def scan_file(path: str) -> tuple[str, Optional[str], Optional[bytes], Optional[str]]:
+    """
+    fingerprint one history file, run in worker processes
+    :param path: path of the history file
+    :return: path, fingerprint, MinHash signature bytes and error message
+    """
+    try:
+        messages = schema.load_history_file(path).history
+        return path, fingerprint(messages), minhash(shingle_hashes(messages)).tobytes(), None
+    except Exception as e:
+        return path, None, None, f'{e.__class__.__name__}: {e}'
+
+
+def lsh_params(threshold: float) -> tuple[int, int]:
+    """
+    LSH bands for a similarity threshold. a pair of similarity `s` shares a band with probability
+    `1 - (1 - s ** rows) ** bands`, the most rows are taken which still catch pairs at `threshold` with
+    probability `LSH_RECALL`, so fewer dissimilar pairs are compared
+    :param threshold: min jaccard similarity of near-duplicates
+    :return: number of bands and rows of each band, `bands * rows <= NUM_PERM`
+    """
+    best = NUM_PERM, 1
+    for rows in range(2, NUM_PERM + 1):
+        bands = NUM_PERM // rows
+        if 1 - (1 - threshold ** rows) ** bands < LSH_RECALL:
+            break
+        best = bands, rows
+    return best
+
+
+class UnionFind:
+    def __init__(self, n: int):
+        self.parent = list(range(n))
+
+    def find(self, i: int) -> int:
+        root = i
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[i] != root:
+            self.parent[i], i = root, self.parent[i]
+        return root
+
+    def union(self, i: int, j: int):
+        i, j = self.find(i), self.find(j)
+        if i != j:
+            self.parent[max(i, j)] = min(i, j)
+
+
+class DedupIndex:
+    """
+    fingerprints and signatures of history files, clustered by `clusters`
+    """
+
+    def __init__(self):
+        self.paths: list[str] = []
+        self.fingerprints: list[str] = []
+        self.signatures: list[bytes] = []
+
+    def add(self, path: str, fingerprint_: str, signature: bytes):
+        self.paths.append(path)
+        self.fingerprints.append(fingerprint_)
+        self.signatures.append(signature)
+
+    def clusters(self, threshold: Optional[float] = 0.8) -> list[tuple[bool, list[str]]]:
+        """
+        group duplicate files, exact duplicates by fingerprint, then near-duplicates by LSH buckets of
+        their signatures, where a candidate joins a bucket only if it is similar enough to the first file.
+        the bands are chosen for `threshold`, see `lsh_params`
+        :param threshold: min estimated jaccard similarity of near-duplicates, only exact duplicates if it is None
+        :return: (whether all files are exact duplicates, sorted paths) of every group of more than one file,
+        sorted by the first path
+        """
+        uf = UnionFind(len(self.paths))
+        first: dict[str, int] = dict()
+        for i, f in enumerate(self.fingerprints):
+            uf.union(first.setdefault(f, i), i)
+
+        if threshold is not None:
+            # one representative per exact group, its duplicates have the same signature
+            representatives = list(first.values())
+            bands, rows = lsh_params(threshold)
+            signatures = np.frombuffer(b''.join(self.signatures[i] for i in representatives),
+                                       dtype=np.uint32).reshape(-1, NUM_PERM)
+            for band in range(bands):
+                buckets: dict[bytes, int] = dict()
+                band_bytes = np.ascontiguousarray(signatures[:, band * rows:(band + 1) * rows])
+                for k, i in enumerate(representatives):
+                    key = band_bytes[k].tobytes()
+                    j = buckets.setdefault(key, k)
+                    if j != k and uf.find(representatives[j]) != uf.find(i) and \
+                            np.count_nonzero(signatures[j] == signatures[k]) >= threshold * NUM_PERM:
+                        uf.union(representatives[j], i)
+
+        groups: dict[int, list[int]] = dict()
+        for i in range(len(self.paths)):
+            groups.setdefault(uf.find(i), []).append(i)
+        result = []
+        for members in groups.values():
+            if len(members) > 1:
+                exact = len({self.fingerprints[i] for i in members}) == 1
+                result.append((exact, sorted(self.paths[i] for i in members)))
+        result.sort(key=lambda c: c[1][0])
+        return result
+
+
+def build_index(paths: list[str], workers: int = 0,
+                cancelled: threading.Event = None) -> tuple[DedupIndex, list[tuple[str, str]]]:
+    """
+    fingerprint every file in a single pass
+    :param paths: paths of history files
+    :param workers: number of worker processes, 0 scans in this process
+    :param cancelled: stop between files as soon as it is set
+    :return: index and (path, error message) of files which can not be loaded
+    :raise CancelledError: if `cancelled` is set before all files are fingerprinted
+    """
+    index, errors = DedupIndex(), []
+    executor = process_pool.create(workers)
+    try:
+        if executor is None:
+            results = map(scan_file, paths)
+        else:
+            results = executor.map(scan_file, paths, chunksize=max(1, min(32, len(paths) // (workers * 4))))
+        for path, f, signature, error in results:
+            if cancelled is not None and cancelled.is_set():
+                raise CancelledError()
+            if error is not None:
+                errors.append((path, error))
+            else:
+                index.add(path, f, signature)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+    return index, errors
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m dedup',
+                                     description='find exact and near-duplicate history files')
+    parser.add_argument('inputs', nargs='+', help='folders or glob patterns of history json files')
+    parser.add_argument('-t', '--threshold', type=float, default=0.8,
+                        help='min similarity of near-duplicates, between 0 and 1')
+    parser.add_argument('--exact', action='store_true', help='only report exact duplicates')
+    parser.add_argument('-o', '--output', default=None, help='json file to write clusters into, default stdout')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count() or 1,
+                        help='number of worker processes, 0 scans in this process')
+    args = parser.parse_args(argv)
+    if not 0 <= args.threshold <= 1:
+        parser.error('threshold must be between 0 and 1')
+
+    paths = schema.collect_paths(args.inputs)
+    if len(paths) == 0:
+        print('No history file found.', file=sys.stderr)
+        return 1
+
+    start = time.perf_counter()
+    index, errors = build_index(paths, args.workers)
+    for path, error in errors:
+        print(f'{path}: {error}', file=sys.stderr)
+    clusters = index.clusters(None if args.exact else args.threshold)
+    elapsed = max(time.perf_counter() - start, 1e-9)
+
+    text = json.dumps([{'exact': exact, 'paths': p} for exact, p in clusters], ensure_ascii=False, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w', encoding='utf8') as f:
+            f.write(text)
+            f.write('\n')
+    print(f'{len(index.paths)} scanned, {len(errors)} failed, {len(clusters)} clusters of '
+          f'{sum(len(p) for _, p in clusters)} files in {elapsed:.2f}s: {len(paths) / elapsed:.1f} files/s',
+          file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
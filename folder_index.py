@@ -0,0 +1,106 @@
+import os
+
+from typing_extensions import Optional
+
+import schema
+
+
+class FileEntry:
+    """
+    metadata of a history file, message count and preview are read from the file on first access
+    """
+
+    preview_length = 80
+
+    def __init__(self, path: str, size: int, mtime_ns: int):
+        self.path = path
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self._summary: Optional[tuple[int, str]] = None
+
+    def _summarize(self) -> tuple[int, str]:
+        if self._summary is None:
+            count, preview = 0, ''
+            try:
+                for m in schema.iter_history_file(self.path):
+                    if count == 0:
+                        preview = m.get_text_content().strip().split('\n', 1)[0][:self.preview_length]
+                    count += 1
+            except (OSError, ValueError):
+                count, preview = 0, ''
+            self._summary = count, preview
+        return self._summary
+
+    @property
+    def message_count(self) -> int:
+        return self._summarize()[0]
+
+    @property
+    def preview(self) -> str:
+        """first line of the first message"""
+        return self._summarize()[1]
+
+
+class FolderIndex:
+    """
+    json files of a folder with their metadata, `refresh` only rebuilds entries whose size or mtime changed
+    """
+
+    def __init__(self, folder: str):
+        self.folder = folder.replace('\\', '/')
+        self.entries: dict[str, FileEntry] = dict()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.folder, name).replace('\\', '/')
+
+    def refresh(self) -> tuple[list[str], list[str], list[str]]:
+        """
+        rescan the folder with `os.scandir`
+        :return: paths which are added, changed and removed since last refresh
+        """
+        added, changed = [], []
+        seen = set()
+        with os.scandir(self.folder) as it:
+            for e in it:
+                if not e.name.endswith('.json') or not e.is_file():
+                    continue
+                path = self._path(e.name)
+                seen.add(path)
+                stat = e.stat()
+                old = self.entries.get(path)
+                if old is None:
+                    added.append(path)
+                elif old.mtime_ns != stat.st_mtime_ns or old.size != stat.st_size:
+                    changed.append(path)
+                else:
+                    continue
+                self.entries[path] = FileEntry(path, stat.st_size, stat.st_mtime_ns)
+        removed = [p for p in self.entries if p not in seen]
+        for p in removed:
+            self.entries.pop(p)
+        return added, changed, removed
+
+    def update_file(self, path: str) -> Optional[str]:
+        """
+        refresh a single file without rescanning the folder
+        :param path: path of the file, it is ignored if it is not in this folder
+        :return: `added`, `changed`, `removed` or None if nothing changed
+        """
+        path = path.replace('\\', '/')
+        if path[:path.rfind('/')] != self.folder or not path.endswith('.json'):
+            return None
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return 'removed' if self.entries.pop(path, None) is not None else None
+        old = self.entries.get(path)
+        if old is not None and old.mtime_ns == stat.st_mtime_ns and old.size == stat.st_size:
+            return None
+        self.entries[path] = FileEntry(path, stat.st_size, stat.st_mtime_ns)
+        return 'added' if old is None else 'changed'
+
+    def paths(self) -> list[str]:
+        """
+        :return: paths of indexed files, sorted by name
+        """
+        return sorted(self.entries)
@@ -0,0 +1,118 @@
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from typing_extensions import Optional
+
+import schema
+import thumbnail
+from blob_store import BlobStore
+
+
+class PrefetchJob:
+    def __init__(self, size: int, mtime_ns: int, future: Future):
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.future = future
+
+
+class Prefetcher:
+    """
+    load history files which are likely to be opened next in a background thread, one file at a time,
+    and decode thumbnails of their first messages into `thumbnail.cache`.
+    must be used from a single thread, usually the Tk main loop
+    """
+
+    def __init__(self, max_bytes: int = 128 * 1024 * 1024, thumbnail_size: Optional[int] = None,
+                 thumbnail_count: int = 0):
+        """
+        :param max_bytes: max total size of prefetched files, parsed files take about as much memory as their size
+        :param thumbnail_size: max size of thumbnails to decode, no thumbnail is decoded if it is None
+        :param thumbnail_count: decode thumbnails of images in this many first messages
+        """
+        self.max_bytes = max_bytes
+        self.thumbnail_size = thumbnail_size
+        self.thumbnail_count = thumbnail_count
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='prefetch')
+        self._jobs: dict[str, PrefetchJob] = dict()
+
+    def _load(self, path: str) -> tuple[int, int, list[schema.Message], bool]:
+        """
+        run in prefetch thread
+        :return: size and mtime of the file before reading it, messages and whether the file has extra fields
+        """
+        stat = os.stat(path)
+        obj = schema.read_json_file(path)
+        messages = schema.parse_history(obj, BlobStore.for_file(path)).history
+        has_extra = schema.has_extra_fields(obj)
+        if self.thumbnail_size is not None:
+            for m in messages[:self.thumbnail_count]:
+                if isinstance(m.content, str):
+                    continue
+                for c in m.content:
+                    if isinstance(c, schema.ImageContent):
+                        try:
+                            thumbnail.get_content_thumbnail(c, self.thumbnail_size)
+                        except Exception:
+                            # the image label shows the error once the file is opened
+                            pass
+        return stat.st_size, stat.st_mtime_ns, messages, has_extra
+
+    def prefetch(self, paths: list[str]):
+        """
+        start loading `paths` in order and drop prefetched files which are not in `paths`.
+        files are skipped once `max_bytes` is used up, large files which are streamed are always skipped
+        :param paths: files which are likely to be opened next, the most likely first
+        :return: None
+        """
+        wanted: dict[str, os.stat_result] = dict()
+        budget = self.max_bytes
+        for p in paths:
+            try:
+                stat = os.stat(p)
+            except OSError:
+                continue
+            if stat.st_size > schema.STREAM_THRESHOLD or stat.st_size > budget:
+                continue
+            budget -= stat.st_size
+            wanted[p] = stat
+
+        for p in list(self._jobs):
+            job, stat = self._jobs[p], wanted.get(p)
+            if stat is None or job.size != stat.st_size or job.mtime_ns != stat.st_mtime_ns:
+                job.future.cancel()
+                del self._jobs[p]
+        for p, stat in wanted.items():
+            if p not in self._jobs:
+                self._jobs[p] = PrefetchJob(stat.st_size, stat.st_mtime_ns, self._executor.submit(self._load, p))
+
+    def take(self, path: str) -> Optional[tuple[list[schema.Message], bool]]:
+        """
+        hand over a prefetched file, waiting for it if it is being loaded right now
+        :param path: path of the file to open
+        :return: messages and whether the file has extra fields, see `schema.has_extra_fields`,
+        None if the file is not prefetched, failed to load or changed since it was loaded
+        """
+        job = self._jobs.pop(path, None)
+        if job is None or job.future.cancel():
+            return None
+        try:
+            size, mtime_ns, messages, has_extra = job.future.result()
+            stat = os.stat(path)
+        except Exception:
+            return None
+        if stat.st_size != size or stat.st_mtime_ns != mtime_ns:
+            return None
+        return messages, has_extra
+
+    def clear(self):
+        for job in self._jobs.values():
+            job.future.cancel()
+        self._jobs.clear()
+
+    def shutdown(self):
+        """
+        drop prefetched files and stop the prefetch thread without waiting for the file being loaded
+        :return: None
+        """
+        self.clear()
+        self._executor.shutdown(wait=False, cancel_futures=True)
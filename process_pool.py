@@ -0,0 +1,18 @@
+"""
+process pools of the command line tools, which also run in threads of the Tk app
+"""
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from typing_extensions import Optional
+
+
+def create(workers: int) -> Optional[ProcessPoolExecutor]:
+    """
+    :param workers: number of worker processes
+    :return: pool of `workers` processes, None if `workers` is 0 and the work is done in the calling process
+    """
+    if workers <= 0:
+        return None
+    # spawn rather than fork, forking a process with threads, e.g. the Tk app, may copy a held lock
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
@@ -0,0 +1,160 @@
+"""
+lightweight timing spans, aggregated as per-phase log2 histograms.
+spans cost a single attribute check while profiling is disabled
+"""
+import cProfile
+import functools
+import os
+import threading
+import time
+
+from typing_extensions import Callable, Optional
+
+enabled = os.environ.get('CONVERSATION_EDITOR_PROFILE', '') not in ('', '0')
+"""whether spans are recorded, can be switched at runtime with `set_enabled`"""
+
+
+class Histogram:
+    """
+    durations of one phase, bucket `i` counts durations in [2^(i-1), 2^i) microseconds
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+        self.buckets: dict[int, int] = dict()
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+        bucket = int(seconds * 1e6).bit_length()
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def format(self) -> str:
+        lines = [f'count={self.count} total={self.total * 1e3:.2f}ms mean={self.total / self.count * 1e3:.3f}ms '
+                 f'min={self.min * 1e3:.3f}ms max={self.max * 1e3:.3f}ms']
+        width = max(self.buckets.values())
+        for bucket in range(min(self.buckets), max(self.buckets) + 1):
+            n = self.buckets.get(bucket, 0)
+            upper = 1 << bucket
+            lines.append(f'  < {_format_us(upper):>8s} {n:8d} {"#" * (n * 40 // width)}')
+        return '\n'.join(lines)
+
+
+def _format_us(us: int) -> str:
+    if us >= 1000000:
+        return f'{us / 1000000:g}s'
+    if us >= 1000:
+        return f'{us / 1000:g}ms'
+    return f'{us}us'
+
+
+_lock = threading.Lock()
+_histograms: dict[str, Histogram] = dict()
+_capture: Optional[tuple[str, str]] = None
+"""(span name, output path) of the next span to run under cProfile"""
+_capturing = False
+
+
+def set_enabled(value: bool):
+    global enabled
+    enabled = value
+
+
+def record(name: str, seconds: float):
+    with _lock:
+        h = _histograms.get(name)
+        if h is None:
+            h = _histograms[name] = Histogram()
+        h.add(seconds)
+
+
+def capture(name: str, path: str):
+    """
+    run the next span `name` under cProfile and dump its stats to `path`, which can be read with `pstats`.
+    only the thread running the span is profiled
+    :param name: span name
+    :param path: output file of the stats
+    :return: None
+    """
+    global _capture
+    with _lock:
+        _capture = name, path
+
+
+class span:
+    """
+    context manager which records how long its block takes under `name`, nothing is done if profiling is disabled
+    """
+
+    __slots__ = ('name', 'start', 'profile', 'output')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.start: Optional[float] = None
+        self.profile: Optional[cProfile.Profile] = None
+        self.output: Optional[str] = None
+
+    def __enter__(self):
+        global _capture, _capturing
+        if not enabled and _capture is None:
+            return self
+        if _capture is not None and _capture[0] == self.name:
+            with _lock:
+                # cProfile can not be nested, later spans of the same name run without it
+                if _capture is not None and _capture[0] == self.name and not _capturing:
+                    self.output = _capture[1]
+                    _capture = None
+                    _capturing = True
+                    self.profile = cProfile.Profile()
+            if self.profile is not None:
+                self.profile.enable()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        global _capturing
+        if self.profile is not None:
+            self.profile.disable()
+            self.profile.dump_stats(self.output)
+            self.profile = None
+            with _lock:
+                _capturing = False
+        if enabled and self.start is not None:
+            record(self.name, time.perf_counter() - self.start)
+
+
+def timed(name: str) -> Callable[[Callable], Callable]:
+    """
+    decorator which runs every call of the function in `span(name)`
+    """
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def report() -> str:
+    """
+    :return: text histograms of every phase, sorted by name
+    """
+    with _lock:
+        return '\n\n'.join(f'{name}\n{h.format()}' for name, h in sorted(_histograms.items()))
+
+
+def dump(path: str):
+    with open(path, 'w', encoding='utf8') as f:
+        f.write(report())
+        f.write('\n')
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
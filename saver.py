@@ -0,0 +1,182 @@
+import itertools
+import os
+import shutil
+import threading
+import traceback
+from collections import OrderedDict
+
+from typing_extensions import Callable, Iterable, Iterator, Optional
+
+import profiling
+import schema
+from blob_store import BlobStore
+
+
+def _report(messages: list[schema.Message], progress: Callable[[int, int], None],
+            every: int = 64) -> Iterator[schema.Message]:
+    for i, m in enumerate(messages):
+        if i % every == 0:
+            progress(i, len(messages))
+        yield m
+    progress(len(messages), len(messages))
+
+
+def _report_tail(messages: list[schema.Message], tail: schema.MessageStream, progress: Callable[[int, int], None],
+                 every: int = 64) -> Iterator[schema.Message]:
+    """
+    progress is counted in bytes of the file `tail` reads, `messages` stand for the part it has already read
+    """
+    start = tail.tell()
+    for i, m in enumerate(messages):
+        if i % every == 0:
+            progress(start * i // len(messages), tail.size)
+        yield m
+    for i, m in enumerate(tail):
+        if i % every == 0:
+            progress(tail.tell(), tail.size)
+        yield m
+    progress(tail.size, tail.size)
+
+
+def write_history_atomic(path: str, messages: Iterable[schema.Message], blob_store: Optional[BlobStore] = None,
+                         progress: Optional[Callable[[int, int], None]] = None,
+                         tail: Optional[schema.MessageStream] = None):
+    """
+    write a history file through a temp file in the same folder, which is fsynced and renamed over `path`,
+    so `path` holds either the old or the new content even if the process dies while writing
+    :param path: path of the history file
+    :param messages: messages to write
+    :param blob_store: see `schema.write_history_json`
+    :param progress: called with (written messages, total messages) once in a while,
+    or (read bytes, file size) of `tail` if it is given
+    :param tail: unread rest of a large file, its messages are read and written after `messages`.
+    it is closed afterward
+    :return: None
+    """
+    folder = os.path.dirname(os.path.abspath(path))
+    tmp_path = os.path.join(folder, f'.{os.path.basename(path)}.{os.getpid()}.tmp')
+    try:
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            if tail is not None:
+                messages = itertools.chain(messages, tail) if progress is None else \
+                    _report_tail(list(messages), tail, progress)
+            elif progress is not None:
+                messages = _report(list(messages), progress)
+            schema.write_history_json(messages, f, blob_store)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(path):
+            shutil.copymode(path, tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    finally:
+        if tail is not None:
+            tail.close()
+
+    # make the rename itself durable, not supported on Windows
+    try:
+        dir_fd = os.open(folder, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
+
+
+class SaveJob:
+    def __init__(self, path: str, messages: list[schema.Message], blob_store: Optional[BlobStore],
+                 progress: Optional[Callable[[str, int, int], None]],
+                 done: Optional[Callable[[str, Optional[BaseException]], None]],
+                 tail: Optional[schema.MessageStream] = None):
+        self.path = path
+        self.messages = messages
+        self.tail = tail
+        self.blob_store = blob_store
+        self.progress = progress
+        self.done = done
+
+
+class Saver:
+    """
+    write history files with `write_history_atomic` in a background thread, one file at a time.
+    a job waiting for a path replaces the previous waiting job of the same path, so repeated saves of a file
+    queue at most one write besides the one in progress
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._pending: OrderedDict[str, SaveJob] = OrderedDict()
+        self._running: Optional[str] = None
+        self._thread = threading.Thread(target=self._run, name='saver', daemon=True)
+        self._thread.start()
+
+    def submit(self, path: str, messages: list[schema.Message], blob_store: Optional[BlobStore] = None,
+               progress: Optional[Callable[[str, int, int], None]] = None,
+               done: Optional[Callable[[str, Optional[BaseException]], None]] = None,
+               tail: Optional[schema.MessageStream] = None):
+        """
+        queue a write, callbacks are called in the saver thread
+        :param path: path of the history file
+        :param messages: messages to write, they must not be modified afterward
+        :param tail: unread rest of a large file, see `write_history_atomic`. the saver thread owns it afterward
+        :param blob_store: see `schema.write_history_json`
+        :param progress: called with (path, written messages, total messages) once in a while
+        :param done: called with (path, exception or None) when the write is finished or has failed,
+        not called if the job is replaced by a newer one
+        :return: None
+        """
+        with self._cond:
+            old = self._pending.get(path)
+            if old is not None and old.tail is not None:
+                old.tail.close()
+            self._pending[path] = SaveJob(path, messages, blob_store, progress, done, tail)
+            self._cond.notify_all()
+
+    def is_busy(self, path: Optional[str] = None) -> bool:
+        """
+        :param path: only check writes of this file, writes of any file if it is None
+        :return: whether a write is queued or in progress
+        """
+        with self._cond:
+            if path is None:
+                return self._running is not None or len(self._pending) > 0
+            return self._running == path or path in self._pending
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        wait until every queued write is finished
+        :return: False on timeout
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: self._running is None and len(self._pending) == 0, timeout)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: len(self._pending) > 0)
+                _, job = self._pending.popitem(last=False)
+                self._running = job.path
+            error = None
+            try:
+                with profiling.span('save_history.write'):
+                    write_history_atomic(job.path, job.messages, job.blob_store,
+                                         None if job.progress is None else lambda i, n: job.progress(job.path, i, n),
+                                         job.tail)
+            except Exception as e:
+                error = e
+            if job.done is not None:
+                try:
+                    job.done(job.path, error)
+                except Exception:
+                    traceback.print_exc()
+            with self._cond:
+                self._running = None
+                self._cond.notify_all()
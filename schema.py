@@ -1,10 +1,27 @@
 import base64
+import binascii
+import glob
 import io
+import json
+import mimetypes
+import os
+import shutil
 import time
+from functools import partial
 
 import PIL.Image
-from pydantic import BaseModel, model_validator
-from typing_extensions import Literal, Optional, Union
+from pydantic import BaseModel, PrivateAttr, model_validator
+from typing_extensions import Callable, Iterable, Iterator, Literal, Optional, TextIO, Union
+
+from blob_store import BlobStore
+
+try:
+    import orjson
+
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+"""fastest available json parser, orjson if it is installed, its errors subclass `json.JSONDecodeError`"""
 
 
 class TextContent(BaseModel):
@@ -37,6 +54,13 @@ class Image(BaseModel):
 class ImageContent(BaseModel):
     type: Literal['image_url'] = 'image_url'
     image_url: Image
+    """inline `data:<mime>;base64,<data>` url, or `blob:<mime>;sha256,<digest>` url of an image in a `BlobStore`"""
+
+    _blob_store: Optional[BlobStore] = PrivateAttr(default=None)
+    _bytes_cache: Optional[tuple[str, bytes]] = PrivateAttr(default=None)
+    """(url, image bytes), dropped by `release`, the url tells if the cache is stale"""
+    _hash_cache: Optional[tuple[str, str]] = PrivateAttr(default=None)
+    _info_cache: Optional[tuple[str, tuple[tuple[int, int], str]]] = PrivateAttr(default=None)
 
     def __eq__(self, other):
         if not isinstance(other, ImageContent):
@@ -47,8 +71,154 @@ class ImageContent(BaseModel):
     def __repr__(self):
         return super().__repr__().removeprefix(self.__class__.__name__).replace('(', '{').replace(')', '}')
 
+    def get_mime_type(self) -> str:
+        """
+        get MIME type from `data:<mime>;base64,` or `blob:<mime>;sha256,` prefix of the url
+        :return: MIME type, `image/jpeg` if the url has no prefix
+        """
+        url = self.image_url.url
+        if url.startswith('data:') or url.startswith('blob:'):
+            return url[url.find(':') + 1:url.find(',')].split(';')[0] or 'image/jpeg'
+        return 'image/jpeg'
+
+    def is_blob(self) -> bool:
+        return self.image_url.url.startswith('blob:')
+
+    def get_blob_digest(self) -> str:
+        """
+        :return: sha256 hex digest of the blob url
+        :raise ValueError: if the url does not hold a valid digest
+        """
+        url = self.image_url.url
+        return BlobStore.check_digest(url[url.find(',') + 1:])
+
+    def bind_blob_store(self, blob_store: BlobStore):
+        """
+        set the store which blob url refers to, done by `parse_history`
+        """
+        self._blob_store = blob_store
+
+    def _get_blob_store(self) -> BlobStore:
+        if self._blob_store is None:
+            raise ValueError('image refers to a blob store, but no blob store is bound')
+        return self._blob_store
+
+    def _load_image_bytes(self) -> bytes:
+        """
+        decode or read image bytes without caching them, cached bytes of `get_image_bytes` are used if there are any
+        :return: image file bytes
+        """
+        url = self.image_url.url
+        # read once, `release` may run in another thread
+        cached = self._bytes_cache
+        if cached is not None and cached[0] is url:
+            return cached[1]
+        if url.startswith('blob:'):
+            return self._get_blob_store().get(self.get_blob_digest())
+        return base64.b64decode(url[url.find(',') + 1:] if url.startswith('data:') else url)
+
     def get_image_bytes(self) -> bytes:
-        return base64.b64decode(self.image_url.url.removeprefix('data:image/jpeg;base64,'))
+        """
+        decode or read image bytes, they are cached until `release` is called
+        :return: image file bytes
+        """
+        data = self._load_image_bytes()
+        self._bytes_cache = self.image_url.url, data
+        return data
+
+    def release(self):
+        """
+        drop cached image bytes, hash and `probe` result are small and kept
+        """
+        self._bytes_cache = None
+
+    def get_hash(self) -> str:
+        """
+        :return: sha256 hex digest of image bytes, cached. free for blob images
+        """
+        url = self.image_url.url
+        if self._hash_cache is None or self._hash_cache[0] is not url:
+            self._hash_cache = url, self.get_blob_digest() if self.is_blob() else BlobStore.digest(
+                self.get_image_bytes())
+        return self._hash_cache[1]
+
+    def _read_head(self, n: int) -> tuple[bytes, bool]:
+        """
+        :return: first `n` or a few more image bytes, and whether they are the whole image
+        """
+        url = self.image_url.url
+        cached = self._bytes_cache
+        if cached is not None and cached[0] is url:
+            data = cached[1]
+            return data[:n], n >= len(data)
+        if url.startswith('blob:'):
+            with open(self._get_blob_store().path(self.get_blob_digest()), 'rb') as f:
+                data = f.read(n)
+            return data, len(data) < n
+        encoded = url[url.find(',') + 1:] if url.startswith('data:') else url
+        chars = (n + 2) // 3 * 4
+        if chars >= len(encoded):
+            return self._load_image_bytes(), True
+        return base64.b64decode(encoded[:chars]), False
+
+    def probe(self) -> tuple[tuple[int, int], str]:
+        """
+        get image size and format from the image header, neither the whole image nor its pixels are decoded.
+        the result is cached
+        :return: ((width, height), PIL format name)
+        """
+        url = self.image_url.url
+        if self._info_cache is not None and self._info_cache[0] is url:
+            return self._info_cache[1]
+        n = 64 * 1024
+        while True:
+            try:
+                head, complete = self._read_head(n)
+            except binascii.Error:
+                # base64 with line breaks can not be cut anywhere, decode all of it
+                head, complete = self._load_image_bytes(), True
+            try:
+                with PIL.Image.open(io.BytesIO(head)) as img:
+                    info = img.size, img.format
+                break
+            except (PIL.UnidentifiedImageError, OSError):
+                if complete:
+                    raise
+                n *= 8
+        self._info_cache = url, info
+        return info
+
+    def to_inline(self) -> 'ImageContent':
+        """
+        :return: image content with inline data url, self if it is already inline
+        """
+        if not self.is_blob():
+            return self
+        return ImageContent.from_bytes(self._load_image_bytes(), self.get_mime_type())
+
+    def to_blob(self, blob_store: BlobStore) -> 'ImageContent':
+        """
+        put image bytes into `blob_store`
+        :param blob_store: store to put the image into
+        :return: image content refers to `blob_store`, self if it is already there
+        """
+        if self.is_blob() and self._blob_store is not None and self._blob_store.root == blob_store.root:
+            return self
+        # runs in the saver thread for every image, bytes are not cached on the shown message
+        digest = blob_store.put(self._load_image_bytes())
+        content = ImageContent(image_url=Image(url=f'blob:{self.get_mime_type()};sha256,{digest}'))
+        content.bind_blob_store(blob_store)
+        return content
+
+    @classmethod
+    def from_bytes(cls, data: bytes, mime_type: str = 'image/jpeg') -> 'ImageContent':
+        """
+        build image content from original image bytes without re-encoding them
+        :param data: image file bytes
+        :param mime_type: MIME type of `data`
+        :return: image content with a base64 data url
+        """
+        return cls(image_url=Image(url=f'data:{mime_type};base64,' + base64.b64encode(data).decode('utf8')))
 
 
 class Message(BaseModel):
@@ -60,6 +230,9 @@ class Message(BaseModel):
 
     timestamp: str = time.strftime("%Y-%m-%d_%H-%M-%S", time.localtime())
 
+    _json_cache: Optional[str] = PrivateAttr(default=None)
+    _blob_json_cache: Optional[tuple[str, str]] = PrivateAttr(default=None)
+
     def get_text_content(self) -> str:
         if isinstance(self.content, str):
             return self.content
@@ -91,6 +264,48 @@ class Message(BaseModel):
                     tmp.append(image_token)
             return '\n'.join(tmp)
 
+    def _map_images(self, func: Callable[[ImageContent], ImageContent]) -> 'Message':
+        if not isinstance(self.content, list):
+            return self
+        content = [func(c) if isinstance(c, ImageContent) else c for c in self.content]
+        if all(a is b for a, b in zip(content, self.content)):
+            return self
+        return Message(role=self.role, content=content, name=self.name, timestamp=self.timestamp)
+
+    def to_inline(self) -> 'Message':
+        """
+        :return: message whose images are all inline, self if they are already inline
+        """
+        return self._map_images(ImageContent.to_inline)
+
+    def to_blob(self, blob_store: BlobStore) -> 'Message':
+        """
+        :param blob_store: store to put images into
+        :return: message whose images are all in `blob_store`, self if they are already there
+        """
+        return self._map_images(partial(ImageContent.to_blob, blob_store=blob_store))
+
+    def dump_json(self, blob_store: Optional[BlobStore] = None) -> str:
+        """
+        `model_dump_json(indent=2)` of this message as an item of the `history` list, every line but the first is
+        indented by 4 more spaces. cached after the first call, so saving again does not indent it again.
+        a message should be treated as read-only once it is dumped, build a new one for edits
+        :param blob_store: dump images as blob urls of this store, images are dumped inline if it is None
+        :return: json string
+        """
+        # read private attributes from their dict, `BaseModel.__getattr__` costs more than dumping a short message
+        private = self.__pydantic_private__
+        if blob_store is None:
+            cache = private['_json_cache']
+            if cache is None:
+                cache = private['_json_cache'] = self.to_inline().model_dump_json(indent=2).replace('\n', '\n    ')
+            return cache
+        cache = private['_blob_json_cache']
+        if cache is None or cache[0] != blob_store.root:
+            cache = private['_blob_json_cache'] = (
+                blob_store.root, self.to_blob(blob_store).model_dump_json(indent=2).replace('\n', '\n    '))
+        return cache[1]
+
     def __eq__(self, other):
         if not isinstance(other, Message):
             return False
@@ -111,14 +326,410 @@ class History(BaseModel):
     def __repr__(self):
         return super().__repr__().removeprefix(self.__class__.__name__).replace('(', '{').replace(')', '}')
 
+    def bind_blob_store(self, blob_store: BlobStore):
+        """
+        set the store which blob urls of every image refer to
+        """
+        for m in self.history:
+            if isinstance(m.content, list):
+                for c in m.content:
+                    if isinstance(c, ImageContent) and c.is_blob():
+                        c.bind_blob_store(blob_store)
+
+    def to_inline(self) -> 'History':
+        """
+        :return: history in the classic format, every image is an inline data url
+        """
+        return History(history=[m.to_inline() for m in self.history])
+
+
+def get_message_list(obj: Union[dict, list]):
+    """
+    :param obj: json object of a history file, see `parse_history`
+    :return: raw message list of `obj`, None if it has none. it is not checked to be a list
+    """
+    if isinstance(obj, list):
+        return obj
+    elif isinstance(obj, dict) and 'history' not in obj and 'messages' in obj:
+        return obj['messages']
+    elif isinstance(obj, dict):
+        return obj.get('history')
+    return None
+
+
+def parse_history(obj: Union[dict, list], blob_store: Optional[BlobStore] = None) -> History:
+    """
+    build `History` from json object of a history file, which can be a bare message list,
+    `{"history": [...]}` or `{"messages": [...]}`
+    :param obj: json object of a history file
+    :param blob_store: store which blob urls refer to, usually `BlobStore.for_file` of the history file
+    :return: history
+    :raise pydantic.ValidationError: if `obj` is not a valid history
+    """
+    history = History(history=get_message_list(obj))
+    if blob_store is not None:
+        history.bind_blob_store(blob_store)
+    return history
+
+
+def read_json_file(path: str) -> Union[dict, list]:
+    """
+    parse a json file with `json_loads`
+    :param path: path of the json file
+    :return: json object
+    """
+    with open(path, 'rb') as f:
+        return json_loads(f.read())
+
+
+def load_history_file(path: str) -> History:
+    """
+    load a history json file, see `parse_history`. blob urls refer to the `.blobs` folder next to the file
+    :param path: path of the json file
+    :return: history
+    """
+    return parse_history(read_json_file(path), BlobStore.for_file(path))
+
+
+def iter_history_files(folder: str) -> Iterator[str]:
+    """
+    :param folder: folder to scan, not recursive
+    :return: paths of json files in `folder`, sorted by name
+    """
+    with os.scandir(folder) as it:
+        names = sorted(e.name for e in it if e.name.endswith('.json') and e.is_file())
+    for name in names:
+        yield os.path.join(folder, name).replace('\\', '/')
+
+
+def collect_paths(inputs: list[str]) -> list[str]:
+    """
+    :param inputs: folders or glob patterns of history files
+    :return: paths of history files, without duplicates
+    """
+    paths = []
+    for i in inputs:
+        if os.path.isdir(i):
+            paths.extend(iter_history_files(i))
+        else:
+            paths.extend(sorted(p.replace('\\', '/') for p in glob.glob(i, recursive=True) if os.path.isfile(p)))
+    return list(dict.fromkeys(paths))
+
+
+def has_extra_fields(obj: Union[dict, list]) -> bool:
+    """
+    check whether a loaded json object holds anything that `History` would drop,
+    e.g. it is a bare message list, uses `messages` as key or has extra keys
+    :param obj: json object of a history file
+    :return: True if saving it as `History` loses information
+    """
+    if not isinstance(obj, dict) or set(obj.keys()) != {'history'} or not isinstance(obj['history'], list):
+        return True
+    return any(has_extra_message_fields(m) for m in obj['history'])
+
+
+def has_extra_message_fields(m) -> bool:
+    """
+    :param m: json object of a message
+    :return: True if saving it as `Message` loses information
+    """
+    return not isinstance(m, dict) or not m.keys() <= Message.model_fields.keys()
+
+
+STREAM_THRESHOLD = 32 * 1024 * 1024
+"""files larger than this are better read with `MessageStream` than loaded at once"""
+
+
+class MessageStream:
+    """
+    read messages of a history file one by one, only the message being parsed is held in memory.
+    the message list is the `history` or `messages` key which comes first, or the file itself if it is a list
+    """
+
+    chunk_size = 1024 * 1024
+
+    def __init__(self, path: str, blob_store: Optional[BlobStore] = None):
+        """
+        :param path: path of the history file
+        :param blob_store: store which blob urls refer to, `BlobStore.for_file(path)` if it is None
+        :raise ValueError: if the file has no message list
+        """
+        self.path = path
+        self.blob_store = BlobStore.for_file(path) if blob_store is None else blob_store
+        self.has_extra = False
+        """whether the file holds anything that `History` would drop, see `has_extra_fields`.
+        only final once `done` is True"""
+        self.done = False
+        self.count = 0
+        """number of messages read"""
+        self._f = open(path, 'r', encoding='utf8')
+        self.size = os.fstat(self._f.fileno()).st_size
+        """size of the file in bytes"""
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+        self._decoder = json.JSONDecoder()
+        self._in_object = False
+        try:
+            self._find_list()
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        self.done = True
+        self._f.close()
+        self._buf = ''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _fill(self, size: int) -> bool:
+        """
+        read at least `size` more characters into the buffer, consumed characters are dropped
+        :return: False at end of file
+        """
+        if self._eof:
+            return False
+        chunk = self._f.read(size)
+        if chunk == '':
+            self._eof = True
+            return False
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def _peek(self) -> str:
+        """
+        :return: next non-whitespace character, '' at end of file
+        """
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in ' \t\r\n':
+                self._pos += 1
+            if self._pos < len(self._buf) or not self._fill(self.chunk_size):
+                return self._buf[self._pos:self._pos + 1]
+
+    def _expect(self, chars: str) -> str:
+        c = self._peek()
+        if c == '' or c not in chars:
+            raise ValueError(f'not a history: expect one of {chars!r} but got {c!r} in {self.path}')
+        self._pos += 1
+        return c
+
+    def _decode(self):
+        """
+        decode the next json value, more of the file is read while the value is incomplete
+        """
+        self._peek()
+        while True:
+            try:
+                obj, end = self._decoder.raw_decode(self._buf, self._pos)
+                # a number may continue in the next chunk
+                if end < len(self._buf) or self._eof or self._buf[self._pos] in '{["':
+                    self._pos = end
+                    return obj
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            # double the pending characters, so a huge value is decoded a few times rather than once per chunk
+            self._fill(max(self.chunk_size, len(self._buf) - self._pos))
+
+    def _find_list(self):
+        c = self._expect('[{')
+        if c == '[':
+            self.has_extra = True
+            return
+        self._in_object = True
+        while self._peek() != '}':
+            key = self._decode()
+            self._expect(':')
+            if key in ('history', 'messages') and self._peek() == '[':
+                self._pos += 1
+                self.has_extra = self.has_extra or key != 'history'
+                return
+            self._decode()
+            self.has_extra = True
+            if self._peek() == ',':
+                self._pos += 1
+        raise ValueError(f'not a history: no message list in {self.path}')
+
+    def _finish(self):
+        if self._in_object:
+            while self._peek() == ',':
+                self._pos += 1
+                self._decode()
+                self._expect(':')
+                self._decode()
+                self.has_extra = True
+            self._expect('}')
+        self.close()
+
+    def tell(self) -> int:
+        """
+        :return: about how many bytes of the file are read, `size` once it is done
+        """
+        if self.done:
+            return self.size
+        # characters which are buffered but not consumed yet, counted as a byte each
+        return max(0, self._f.buffer.tell() - (len(self._buf) - self._pos))
+
+    def _next_obj(self) -> dict:
+        """
+        :return: raw dict of the next message
+        :raise StopIteration: at the end of the message list
+        """
+        if self.done:
+            raise StopIteration
+        if self.count > 0:
+            c = self._expect(',]')
+        elif self._peek() == ']':
+            c = self._expect(']')
+        else:
+            c = ','
+        if c == ']':
+            self._finish()
+            raise StopIteration
+
+        obj = self._decode()
+        self.has_extra = self.has_extra or has_extra_message_fields(obj)
+        return obj
+
+    def skip(self, n: int) -> int:
+        """
+        skip messages without validating them, e.g. those which are already loaded from another stream
+        :param n: number of messages to skip
+        :return: number of messages skipped, less than `n` at the end of the message list
+        """
+        for i in range(n):
+            try:
+                self._next_obj()
+            except StopIteration:
+                return i
+            self.count += 1
+        return n
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> Message:
+        message = Message.model_validate(self._next_obj())
+        if isinstance(message.content, list):
+            for c in message.content:
+                if isinstance(c, ImageContent) and c.is_blob():
+                    c.bind_blob_store(self.blob_store)
+        self.count += 1
+        return message
+
+    def read(self, n: Optional[int] = None) -> list[Message]:
+        """
+        :param n: max number of messages to read, all remaining messages if it is None
+        :return: next messages, empty if all were read
+        """
+        if n is None:
+            return list(self)
+        messages = []
+        for m in self:
+            messages.append(m)
+            if len(messages) >= n:
+                break
+        return messages
+
+
+def iter_history_file(path: str) -> Iterator[Message]:
+    """
+    iterate messages of a history file, large files are read with `MessageStream` to keep memory use low
+    :param path: path of the json file
+    :return: iterator of messages
+    """
+    if os.path.getsize(path) > STREAM_THRESHOLD:
+        with MessageStream(path) as stream:
+            yield from stream
+    else:
+        yield from load_history_file(path).history
+
+
+def write_history_json(messages: Iterable[Message], f: TextIO, blob_store: Optional[BlobStore] = None):
+    """
+    write messages to `f` one by one, the output is the same as `History(history=messages).model_dump_json(indent=2)`
+    without building the whole json string in memory. json of messages which were dumped before is reused
+    :param messages: messages to write
+    :param f: text file opened for writing
+    :param blob_store: put images into this store and write their blob urls, images are written inline if it is None
+    :return: None
+    """
+    f.write('{\n  "history": [')
+    empty = True
+    for m in messages:
+        f.write('\n    ' if empty else ',\n    ')
+        f.write(m.dump_json(blob_store))
+        empty = False
+    f.write(']\n}' if empty else '\n  ]\n}')
+
 
 def  history_to_ShareGPT(data: Union[dict, History], is_image=True) -> dict:
     if not isinstance(data, History):
         data = History.model_validate(data)
+    return history_to_ShareGPT_record(data, (lambda c: LazyImage(c).open()) if is_image else None)
+
+
+class LazyImage:
+    """
+    handle of an image in ShareGPT export, the image is decoded only when `open` is called
+    """
+
+    def __init__(self, content: ImageContent):
+        self.content = content
+
+    def get_image_bytes(self) -> bytes:
+        return self.content.get_image_bytes()
+
+    def open(self) -> PIL.Image.Image:
+        return PIL.Image.open(io.BytesIO(self.get_image_bytes()))
+
+
+def write_image_file(content: ImageContent, image_dir: str) -> str:
+    """
+    write image bytes into `image_dir`, named by sha256 of the bytes so each image is only written once.
+    images in a blob store are copied without reading them into memory
+    :param content: image to write
+    :param image_dir: folder of image files
+    :return: path of the image file
+    """
+    if content.is_blob():
+        data, digest = None, content.get_blob_digest()
+    else:
+        data = content.get_image_bytes()
+        digest = BlobStore.digest(data)
+    ext = mimetypes.guess_extension(content.get_mime_type()) or '.bin'
+    path = os.path.join(image_dir, digest + ext).replace('\\', '/')
+    if not os.path.exists(path):
+        # several processes may write the same image, so never expose a partially written file
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        if data is None:
+            if content._blob_store is None:
+                raise ValueError('image refers to a blob store, but no blob store is bound')
+            shutil.copyfile(content._blob_store.path(digest), tmp_path)
+        else:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+        os.replace(tmp_path, path)
+    return path
+
+
+def history_to_ShareGPT_record(data: History, image: Optional[Callable[[ImageContent], object]] = None) -> dict:
+    """
+    convert history into a ShareGPT record, images are converted by `image`
+    :param data: history to convert
+    :param image: converts each image content into an entry of `images`, no `images` key if it is None
+    :return: ShareGPT record
+    """
     tmp = {
         "messages": []
     }
-    if is_image:
+    if image is not None:
         tmp['images'] = []
 
     for m in data.history:
@@ -128,9 +739,54 @@ def  history_to_ShareGPT(data: Union[dict, History], is_image=True) -> dict:
             'content': m.get_format_content()
         })
 
-        if isinstance(m.content, list) and is_image:
+        if isinstance(m.content, list) and image is not None:
             for c in m.content:
                 if isinstance(c, ImageContent):
-                    tmp['images'].append(PIL.Image.open(io.BytesIO(c.get_image_bytes())))
-
-    return tmp
\ No newline at end of file
+                    tmp['images'].append(image(c))
+
+    return tmp
+
+
+def iter_ShareGPT(paths: Union[str, Iterable[str]], image_mode: Literal['none', 'lazy', 'path'] = 'lazy',
+                  image_dir: Optional[str] = None) -> Iterator[dict]:
+    """
+    convert history files into ShareGPT records one file at a time, so memory use does not grow with the dataset
+    :param paths: folder of history files or paths of history files
+    :param image_mode: `none` skips images without decoding them, `lazy` gives `LazyImage` handles and
+    `path` writes images into `image_dir` and gives their paths
+    :param image_dir: folder of image files, required by `path` mode
+    :return: iterator of ShareGPT records
+    """
+    if isinstance(paths, str):
+        paths = iter_history_files(paths)
+    if image_mode == 'none':
+        image = None
+    elif image_mode == 'lazy':
+        image = LazyImage
+    elif image_mode == 'path':
+        if image_dir is None:
+            raise ValueError('image_dir is required when image_mode is "path"')
+        os.makedirs(image_dir, exist_ok=True)
+        image = partial(write_image_file, image_dir=image_dir)
+    else:
+        raise ValueError(f'unknown image_mode: {image_mode}')
+
+    for path in paths:
+        yield history_to_ShareGPT_record(load_history_file(path), image)
+
+
+def write_ShareGPT_jsonl(paths: Union[str, Iterable[str]], output_path: str, image_dir: Optional[str] = None) -> int:
+    """
+    export history files into a ShareGPT jsonl file, one record per line
+    :param paths: folder of history files or paths of history files
+    :param output_path: path of the jsonl file
+    :param image_dir: folder to write images into, images are skipped if it is None
+    :return: number of records
+    """
+    count = 0
+    with open(output_path, 'w', encoding='utf8') as f:
+        for record in iter_ShareGPT(paths, 'none' if image_dir is None else 'path', image_dir):
+            f.write(json.dumps(record, ensure_ascii=False))
+            f.write('\n')
+            count += 1
+    return count
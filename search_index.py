@@ -0,0 +1,201 @@
+import operator
+import threading
+from array import array
+from concurrent.futures import CancelledError
+
+import numpy as np
+from typing_extensions import Iterator, Optional
+
+import folder_index
+import schema
+
+MESSAGE_SEPARATOR = '\0'
+"""separates messages in the indexed text of a file"""
+FIELD_SEPARATOR = '\1'
+"""separates role, name and text of a message, so a query never matches across them"""
+
+
+def normalize(text: str) -> str:
+    """
+    :return: lowercase `text` with whitespace collapsed, indexed text and queries are both normalized
+    """
+    return ' '.join(text.lower().split())
+
+
+def ngrams(text: str) -> set[str]:
+    """
+    lowercase unigrams and bigrams of `text`, whitespace is collapsed.
+    character n-grams work for both CJK text and prefixes of latin words
+    :param text: text to split
+    :return: set of n-grams
+    """
+    text = normalize(text)
+    grams = set(text)
+    grams.update(map(operator.add, text, text[1:]))
+    grams.discard(' ')
+    return grams
+
+
+def message_texts(path: str) -> Iterator[str]:
+    """
+    :param path: path of a history file
+    :return: iterator of normalized role, name and text of every message, joined by `FIELD_SEPARATOR`
+    """
+    for m in schema.iter_history_file(path):
+        yield (f'{normalize(m.role)}{FIELD_SEPARATOR}{normalize(m.name or "")}{FIELD_SEPARATOR}'
+               f'{normalize(m.get_text_content())}')
+
+
+def query_ngrams(query: str) -> set[str]:
+    """
+    n-grams a file must contain to match `query`
+    :param query: search query
+    :return: bigrams of `query`, or its unigram if it is a single character
+    """
+    grams = ngrams(query)
+    bigrams = {g for g in grams if len(g) == 2}
+    return bigrams if len(bigrams) > 0 else grams
+
+
+class SearchIndex:
+    """
+    thread-safe inverted index from n-gram to history files, see `ngrams`.
+    postings are sorted arrays of file ids, files holding every n-gram of a query are candidates which are
+    read again and checked against the query itself, the text of files is not kept in memory.
+    the text, role and name of every message are indexed
+    """
+
+    compact_threshold = 1024
+    """removed files are dropped from postings once there are this many and more than live files"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._postings: dict[str, array] = dict()
+        """n-gram -> ascending ids of files containing it, may hold ids of removed files"""
+        self._doc_id: dict[str, int] = dict()
+        """path -> doc id"""
+        self._doc_path: dict[int, str] = dict()
+        self._doc_mtime: dict[int, int] = dict()
+        """doc id -> mtime_ns of the file when it was indexed"""
+        self._removed = 0
+        """ids of removed files which are still in postings"""
+        self._next_doc_id = 0
+
+    def __len__(self):
+        return len(self._doc_id)
+
+    def _remove(self, path: str):
+        doc_id = self._doc_id.pop(path, None)
+        if doc_id is None:
+            return
+        # postings are cleaned up lazily by `_compact`, search skips ids which are not in `_doc_path`
+        self._doc_path.pop(doc_id)
+        self._doc_mtime.pop(doc_id)
+        self._removed += 1
+        if self._removed >= self.compact_threshold and self._removed > len(self._doc_path):
+            self._compact()
+
+    def _compact(self):
+        alive = np.fromiter(self._doc_path, dtype=np.uint32, count=len(self._doc_path))
+        for g in list(self._postings):
+            ids = np.frombuffer(self._postings[g], dtype=np.uint32)
+            ids = ids[np.isin(ids, alive, assume_unique=True)]
+            if len(ids) == 0:
+                del self._postings[g]
+            else:
+                self._postings[g] = array('I', ids.tobytes())
+        self._removed = 0
+
+    def remove_file(self, path: str):
+        with self._lock:
+            self._remove(path)
+
+    def add_file(self, path: str, mtime_ns: int):
+        """
+        index a history file, the old entry of `path` is replaced.
+        files which can not be loaded are indexed as empty
+        :param path: path of the history file
+        :param mtime_ns: mtime of the file, used by `sync` to skip unchanged files
+        :return: None
+        """
+        try:
+            grams = ngrams(MESSAGE_SEPARATOR.join(message_texts(path)))
+        except Exception:
+            grams = set()
+
+        with self._lock:
+            self._remove(path)
+            doc_id = self._next_doc_id
+            self._next_doc_id += 1
+            self._doc_id[path] = doc_id
+            self._doc_path[doc_id] = path
+            self._doc_mtime[doc_id] = mtime_ns
+            # doc ids only grow, appending keeps postings sorted
+            for g in grams:
+                posting = self._postings.get(g)
+                if posting is None:
+                    self._postings[g] = array('I', (doc_id,))
+                else:
+                    posting.append(doc_id)
+
+    def sync(self, entries: dict[str, folder_index.FileEntry], cancelled: threading.Event = None):
+        """
+        index files which are new or changed since they were indexed, and drop files which are not in `entries`
+        :param entries: files to index, usually `FolderIndex.entries`
+        :param cancelled: stop as soon as it is set
+        :return: None
+        """
+        with self._lock:
+            removed = [p for p in self._doc_id if p not in entries]
+            indexed = {p: self._doc_mtime[i] for p, i in self._doc_id.items()}
+        for p in removed:
+            self.remove_file(p)
+        for p, e in entries.items():
+            if cancelled is not None and cancelled.is_set():
+                return
+            if indexed.get(p) != e.mtime_ns:
+                self.add_file(p, e.mtime_ns)
+
+    def search(self, query: str, cancelled: threading.Event = None) -> dict[str, Optional[int]]:
+        """
+        find messages which contain `query`, case-insensitive and with whitespace collapsed.
+        candidates are read again to check them, call it in a background thread
+        :param query: search query
+        :param cancelled: stop between files as soon as it is set
+        :return: path -> index of the first matching message, for every matching file.
+        the index is None for queries of up to two characters, files are not read again for them
+        :raise CancelledError: if `cancelled` is set before the search is done
+        """
+        grams = query_ngrams(query)
+        query = normalize(query)
+        if len(grams) == 0:
+            return dict()
+        with self._lock:
+            postings = [self._postings.get(g) for g in grams]
+            if any(p is None for p in postings):
+                return dict()
+            postings.sort(key=len)
+            # copy, a view would stop `add_file` from growing the array
+            hits = np.array(postings[0], dtype=np.uint32)
+            for posting in postings[1:]:
+                if len(hits) == 0:
+                    break
+                hits = np.intersect1d(hits, np.frombuffer(posting, dtype=np.uint32), assume_unique=True)
+            candidates = [self._doc_path[d] for d in hits.tolist() if d in self._doc_path]
+
+        if len(query) <= 2:
+            # a query of one or two characters is an indexed n-gram itself, every candidate matches
+            return dict.fromkeys(candidates)
+        result = dict()
+        for path in candidates:
+            if cancelled is not None and cancelled.is_set():
+                raise CancelledError()
+            try:
+                result[path] = next(i for i, t in enumerate(message_texts(path)) if query in t)
+            except StopIteration:
+                # holds every n-gram but not the query itself
+                pass
+            except Exception:
+                # can not be read any more, it is indexed again once the folder index notices
+                pass
+        return result
@@ -0,0 +1,311 @@
+"""
+dataset statistics of a folder of history files, run it with `python -m stats`.
+per-message features are collected into numpy arrays and aggregated with vectorized operations
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import CancelledError
+
+import numpy as np
+from typing_extensions import Callable, Iterable, Optional
+
+import process_pool
+import schema
+
+ROLES = ['system', 'user', 'assistant']
+"""role of code `i` is `ROLES[i]`, code `len(ROLES)` is any other role"""
+_role_code = {r: i for i, r in enumerate(ROLES)}
+
+
+def _iso_timestamp(timestamp) -> str:
+    """
+    :param timestamp: `%Y-%m-%d_%H-%M-%S` timestamp of `schema.Message`
+    :return: ISO 8601 timestamp which numpy can parse, `NaT` if `timestamp` is not in that format
+    """
+    if not isinstance(timestamp, str) or len(timestamp) != 19 or timestamp[10] != '_':
+        return 'NaT'
+    return f'{timestamp[:10]}T{timestamp[11:13]}:{timestamp[14:16]}:{timestamp[17:19]}'
+
+
+def _to_datetime(timestamps: list[str]) -> np.ndarray:
+    try:
+        return np.array(timestamps, dtype='datetime64[s]')
+    except ValueError:
+        # some timestamps look right but are not dates, e.g. month 13
+        result = np.empty(len(timestamps), dtype='datetime64[s]')
+        for i, t in enumerate(timestamps):
+            try:
+                result[i] = np.datetime64(t, 's')
+            except ValueError:
+                result[i] = np.datetime64('NaT')
+        return result
+
+
+class Features:
+    """
+    per-message features of many history files, messages of a file are contiguous
+    """
+
+    def __init__(self, counts: np.ndarray, role: np.ndarray, chars: np.ndarray, images: np.ndarray,
+                 timestamp: np.ndarray, errors: list[tuple[str, str]]):
+        self.counts = counts
+        """message count of every loaded file"""
+        self.role = role
+        """role code of every message, see `ROLES`"""
+        self.chars = chars
+        """characters of text content of every message"""
+        self.images = images
+        """images of every message"""
+        self.timestamp = timestamp
+        """timestamp of every message, `NaT` if it is missing or malformed"""
+        self.errors = errors
+        """(path, error message) of files which can not be loaded"""
+
+    @classmethod
+    def concatenate(cls, features: Iterable['Features']) -> 'Features':
+        features = list(features)
+        return cls(np.concatenate([f.counts for f in features] or [np.zeros(0, np.int64)]),
+                   np.concatenate([f.role for f in features] or [np.zeros(0, np.int8)]),
+                   np.concatenate([f.chars for f in features] or [np.zeros(0, np.int64)]),
+                   np.concatenate([f.images for f in features] or [np.zeros(0, np.int32)]),
+                   np.concatenate([f.timestamp for f in features] or [np.zeros(0, 'datetime64[s]')]),
+                   [e for f in features for e in f.errors])
+
+
+def _message_features(m) -> tuple[int, int, int, str]:
+    """
+    :param m: raw message dict or `schema.Message`
+    :return: role code, characters, images and ISO timestamp of the message
+    """
+    if isinstance(m, schema.Message):
+        role, content, timestamp = m.role, m.content, m.timestamp
+        if isinstance(content, list):
+            chars = sum(len(c.text) for c in content if isinstance(c, schema.TextContent))
+            images = sum(1 for c in content if isinstance(c, schema.ImageContent))
+        else:
+            chars, images = len(content), 0
+    else:
+        role, content, timestamp = m['role'], m['content'], m.get('timestamp')
+        if isinstance(content, list):
+            chars = sum(len(c['text']) for c in content if 'text' in c)
+            images = sum(1 for c in content if 'image_url' in c)
+        else:
+            chars, images = len(content), 0
+    return _role_code.get(role, len(ROLES)), chars, images, _iso_timestamp(timestamp)
+
+
+def scan_files(paths: list[str]) -> Features:
+    """
+    collect features of history files, run in worker processes.
+    small files are read as raw json without building models, large files are streamed
+    :param paths: paths of history files
+    :return: features of the files which can be loaded
+    """
+    counts, roles, chars, images, timestamps, errors = [], [], [], [], [], []
+    for path in paths:
+        try:
+            if os.path.getsize(path) > schema.STREAM_THRESHOLD:
+                messages = schema.iter_history_file(path)
+            else:
+                messages = schema.get_message_list(schema.read_json_file(path))
+                if not isinstance(messages, list):
+                    raise ValueError('not a history: no message list')
+            features = [_message_features(m) for m in messages]
+        except Exception as e:
+            errors.append((path, f'{e.__class__.__name__}: {e}'))
+            continue
+        counts.append(len(features))
+        for r, c, i, t in features:
+            roles.append(r)
+            chars.append(c)
+            images.append(i)
+            timestamps.append(t)
+    return Features(np.array(counts, dtype=np.int64), np.array(roles, dtype=np.int8),
+                    np.array(chars, dtype=np.int64), np.array(images, dtype=np.int32), _to_datetime(timestamps),
+                    errors)
+
+
+def collect_features(paths: list[str], workers: int = 0, chunk_size=256,
+                     progress: Optional[Callable[[int, int], None]] = None,
+                     cancelled: threading.Event = None) -> Features:
+    """
+    collect features of every file in a single pass
+    :param paths: paths of history files
+    :param workers: number of worker processes, 0 scans in this process
+    :param chunk_size: files scanned by a worker at once
+    :param progress: called with (scanned files, total files) after every chunk
+    :param cancelled: stop between chunks as soon as it is set
+    :return: features of all files
+    :raise CancelledError: if `cancelled` is set before all files are scanned
+    """
+    chunks = [paths[i:i + chunk_size] for i in range(0, len(paths), chunk_size)]
+    executor = process_pool.create(workers)
+    features, done = [], 0
+    try:
+        for f, chunk in zip(map(scan_files, chunks) if executor is None else executor.map(scan_files, chunks),
+                            chunks):
+            if cancelled is not None and cancelled.is_set():
+                raise CancelledError()
+            features.append(f)
+            done += len(chunk)
+            if progress is not None:
+                progress(done, len(paths))
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+    return Features.concatenate(features)
+
+
+def _summary(values: np.ndarray) -> dict:
+    if len(values) == 0:
+        return {'count': 0}
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return {'count': int(len(values)), 'sum': int(values.sum()), 'mean': float(values.mean()),
+            'min': int(values.min()), 'p50': float(p50), 'p90': float(p90), 'p99': float(p99),
+            'max': int(values.max())}
+
+
+def _log2_histogram(values: np.ndarray) -> dict[str, int]:
+    """
+    :return: `[lower, upper)` -> count, buckets are 0, 1, [2, 4), [4, 8) ...
+    """
+    if len(values) == 0:
+        return dict()
+    buckets = np.zeros(len(values), dtype=np.int64)
+    positive = values > 0
+    buckets[positive] = np.floor(np.log2(values[positive])).astype(np.int64) + 1
+    result = dict()
+    for b, n in enumerate(np.bincount(buckets)):
+        if n == 0:
+            continue
+        if b == 0:
+            key = '0'
+        elif b == 1:
+            key = '1'
+        else:
+            key = f'[{1 << (b - 1)}, {1 << b})'
+        result[key] = int(n)
+    return result
+
+
+def compute_stats(features: Features) -> dict:
+    """
+    :param features: features of a dataset, see `collect_features`
+    :return: json object of aggregates and histograms
+    """
+    counts, role = features.counts, features.role
+    conversation = np.repeat(np.arange(len(counts)), counts)
+
+    per_role = dict()
+    for code, name in enumerate(ROLES + ['other']):
+        mask = role == code
+        if not mask.any():
+            continue
+        per_role[name] = {'messages': int(mask.sum()), 'chars': _summary(features.chars[mask]),
+                          'chars_histogram': _log2_histogram(features.chars[mask]),
+                          'images': int(features.images[mask].sum())}
+
+    images_per_conversation = np.bincount(conversation, weights=features.images,
+                                          minlength=len(counts)).astype(np.int64)
+    chars_per_conversation = np.bincount(conversation, weights=features.chars,
+                                         minlength=len(counts)).astype(np.int64)
+
+    # turns should alternate between user and assistant, system messages are not turns
+    turn = role != _role_code['system']
+    turn_role, turn_conversation = role[turn], conversation[turn]
+    repeated = (turn_role[1:] == turn_role[:-1]) & (turn_conversation[1:] == turn_conversation[:-1])
+    first_turn = np.ones(len(turn_role), dtype=bool)
+    first_turn[1:] = turn_conversation[1:] != turn_conversation[:-1]
+    not_user_first = first_turn & (turn_role != _role_code['user'])
+    violation_conversations = np.union1d(turn_conversation[1:][repeated], turn_conversation[not_user_first])
+
+    timestamp = features.timestamp
+    valid = ~np.isnat(timestamp)
+    timestamps = {'valid': int(valid.sum()), 'missing_or_invalid': int((~valid).sum())}
+    if valid.any():
+        timestamps['min'] = str(timestamp[valid].min()).replace('T', ' ')
+        timestamps['max'] = str(timestamp[valid].max()).replace('T', ' ')
+        # span of every conversation, from its earliest to its latest valid timestamp
+        seconds = timestamp.astype(np.int64)
+        conv_valid = conversation[valid]
+        first = np.full(len(counts), np.iinfo(np.int64).max)
+        last = np.full(len(counts), np.iinfo(np.int64).min)
+        np.minimum.at(first, conv_valid, seconds[valid])
+        np.maximum.at(last, conv_valid, seconds[valid])
+        has_valid = last >= first
+        timestamps['conversation_span_seconds'] = _summary(last[has_valid] - first[has_valid])
+
+    return {
+        'files': int(len(counts)),
+        'failed': len(features.errors),
+        'messages': int(len(role)),
+        'messages_per_conversation': _summary(counts),
+        'messages_per_conversation_histogram': _log2_histogram(counts),
+        'chars_per_conversation': _summary(chars_per_conversation),
+        'roles': per_role,
+        'images': {'total': int(features.images.sum()),
+                   'conversations_with_images': int((images_per_conversation > 0).sum()),
+                   'per_conversation_histogram': _log2_histogram(images_per_conversation)},
+        'alternation': {'repeated_roles': int(repeated.sum()), 'not_user_first': int(not_user_first.sum()),
+                        'conversations_with_violations': int(len(violation_conversations))},
+        'timestamps': timestamps,
+    }
+
+
+def format_stats(stats: dict) -> str:
+    """
+    :param stats: result of `compute_stats`
+    :return: indented text of `stats`
+    """
+    lines = []
+
+    def walk(obj: dict, indent: int):
+        for k, v in obj.items():
+            if isinstance(v, dict):
+                lines.append(f'{"  " * indent}{k}:')
+                walk(v, indent + 1)
+            else:
+                lines.append(f'{"  " * indent}{k}: {v:.2f}' if isinstance(v, float) else f'{"  " * indent}{k}: {v}')
+
+    walk(stats, 0)
+    return '\n'.join(lines)
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m stats', description='statistics of history files')
+    parser.add_argument('inputs', nargs='+', help='folders or glob patterns of history json files')
+    parser.add_argument('--text', action='store_true', help='print indented text instead of json')
+    parser.add_argument('-o', '--output', default=None, help='file to write statistics into, default stdout')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count() or 1,
+                        help='number of worker processes, 0 scans in this process')
+    args = parser.parse_args(argv)
+
+    paths = schema.collect_paths(args.inputs)
+    if len(paths) == 0:
+        print('No history file found.', file=sys.stderr)
+        return 1
+
+    start = time.perf_counter()
+    features = collect_features(paths, args.workers)
+    for path, error in features.errors:
+        print(f'{path}: {error}', file=sys.stderr)
+    stats = compute_stats(features)
+    elapsed = max(time.perf_counter() - start, 1e-9)
+
+    text = format_stats(stats) if args.text else json.dumps(stats, ensure_ascii=False, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w', encoding='utf8') as f:
+            f.write(text)
+            f.write('\n')
+    print(f'{len(paths)} files in {elapsed:.2f}s: {len(paths) / elapsed:.1f} files/s', file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,109 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from io import BytesIO
+
+from PIL import Image
+from typing_extensions import Optional
+
+import profiling
+import schema
+
+executor = ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1), thread_name_prefix='thumbnail')
+"""worker pool which decodes images off the Tk main thread"""
+
+
+class ThumbnailCache:
+    """
+    thread-safe LRU cache from (sha256 of image bytes, max size) to decoded thumbnail,
+    least recently used thumbnails are dropped once their pixels exceed `max_bytes`
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        """pixel bytes of cached thumbnails"""
+        self._lock = threading.Lock()
+        self._data: OrderedDict[tuple[str, int], Image.Image] = OrderedDict()
+
+    @staticmethod
+    def image_bytes(img: Image.Image) -> int:
+        return img.width * img.height * len(img.getbands())
+
+    def get(self, key: tuple[str, int]) -> Optional[Image.Image]:
+        with self._lock:
+            img = self._data.get(key)
+            if img is not None:
+                self._data.move_to_end(key)
+            return img
+
+    def put(self, key: tuple[str, int], img: Image.Image):
+        with self._lock:
+            if key in self._data:
+                self.size -= self.image_bytes(self._data.pop(key))
+            self._data[key] = img
+            self.size += self.image_bytes(img)
+            while self.size > self.max_bytes and len(self._data) > 1:
+                _, old = self._data.popitem(last=False)
+                self.size -= self.image_bytes(old)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._data)
+
+
+cache = ThumbnailCache(256 * 1024 * 1024)
+"""process-wide thumbnail cache shared by every image label"""
+
+
+@profiling.timed('image_decode')
+def make_thumbnail(data: bytes, max_size: int) -> Image.Image:
+    """
+    decode image bytes and downscale it to fit in `max_size`x`max_size`
+    :param data: image file bytes
+    :param max_size: max width and height of the thumbnail
+    :return: decoded thumbnail, only the downscaled pixels are kept
+    """
+    img = Image.open(BytesIO(data))
+    # let JPEG decoder downscale while decoding, other formats ignore it
+    img.draft(img.mode, (max_size, max_size))
+    img.thumbnail((max_size, max_size))
+    # small images are not touched by thumbnail(), make sure they are decoded here rather than by the caller
+    img.load()
+    return img
+
+
+def get_content_thumbnail(content: schema.ImageContent, max_size: int) -> Image.Image:
+    """
+    get thumbnail of `content` from `cache`, decode and cache it if it is not there.
+    it is keyed by `content.get_hash()`, so image bytes are not even decoded on cache hit once the hash is known.
+    image bytes of `content` are released afterward
+    :param content: image content
+    :param max_size: max width and height of the thumbnail
+    :return: decoded thumbnail
+    """
+    try:
+        key = content.get_hash(), max_size
+        img = cache.get(key)
+        if img is None:
+            img = make_thumbnail(content.get_image_bytes(), max_size)
+            cache.put(key, img)
+        return img
+    finally:
+        # the thumbnail is cached by hash, image bytes are read again only when they are needed
+        content.release()
+
+
+def submit_thumbnail(content: schema.ImageContent, max_size: int) -> Future:
+    """
+    get thumbnail of `content` through `get_content_thumbnail` in `executor`
+    :param content: image content to decode
+    :param max_size: max width and height of the thumbnail
+    :return: future of the thumbnail
+    """
+    return executor.submit(get_content_thumbnail, content, max_size)
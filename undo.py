@@ -0,0 +1,331 @@
+from abc import ABC, abstractmethod
+from collections import deque
+
+from typing_extensions import Optional, Union
+
+import schema
+
+
+def _common_prefix(a: str, b: str) -> int:
+    # binary search on slice comparison, which runs in C
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _common_suffix(a: str, b: str, limit: int) -> int:
+    lo, hi = 0, min(len(a), len(b), limit)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[len(a) - mid:] == b[len(b) - mid:]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def diff_text(old: str, new: str) -> tuple[int, str, str]:
+    """
+    :return: start, removed and inserted text, so that replacing `removed` at `start` of `old` with `inserted`
+    gives `new`
+    """
+    start = _common_prefix(old, new)
+    end = _common_suffix(old, new, min(len(old), len(new)) - start)
+    return start, old[start:len(old) - end], new[start:len(new) - end]
+
+
+class _Draft:
+    """
+    mutable copy of a message which changes are applied to, `str` content is a single text content
+    """
+
+    def __init__(self, message: schema.Message):
+        self.role = message.role
+        self.name = message.name
+        self.timestamp = message.timestamp
+        self.is_str = isinstance(message.content, str)
+        self.content: list[Union[schema.TextContent, schema.ImageContent]] = \
+            [schema.TextContent(text=message.content)] if self.is_str else list(message.content)
+
+    def build(self) -> schema.Message:
+        return schema.Message(role=self.role, content=self.content[0].text if self.is_str else self.content,
+                              name=self.name, timestamp=self.timestamp)
+
+
+class Change(ABC):
+    """
+    change of a single message, applied to a `_Draft`
+    """
+
+    @abstractmethod
+    def apply(self, draft: _Draft):
+        ...
+
+    @abstractmethod
+    def revert(self, draft: _Draft):
+        ...
+
+
+class FieldChange(Change):
+    """role, name, timestamp or whether the content is a plain string"""
+
+    def __init__(self, field: str, old, new):
+        self.field = field
+        self.old = old
+        self.new = new
+
+    def apply(self, draft: _Draft):
+        setattr(draft, self.field, self.new)
+
+    def revert(self, draft: _Draft):
+        setattr(draft, self.field, self.old)
+
+
+class TextEdit(Change):
+    def __init__(self, content_index: int, start: int, removed: str, inserted: str):
+        self.content_index = content_index
+        self.start = start
+        self.removed = removed
+        self.inserted = inserted
+
+    def _replace(self, draft: _Draft, old: str, new: str):
+        text = draft.content[self.content_index].text
+        draft.content[self.content_index] = schema.TextContent(
+            text=text[:self.start] + new + text[self.start + len(old):])
+
+    def apply(self, draft: _Draft):
+        self._replace(draft, self.removed, self.inserted)
+
+    def revert(self, draft: _Draft):
+        self._replace(draft, self.inserted, self.removed)
+
+
+class ContentInsert(Change):
+    def __init__(self, content_index: int, content: Union[schema.TextContent, schema.ImageContent]):
+        self.content_index = content_index
+        self.content = content
+
+    def apply(self, draft: _Draft):
+        draft.content.insert(self.content_index, self.content)
+
+    def revert(self, draft: _Draft):
+        draft.content.pop(self.content_index)
+
+
+class ContentDelete(ContentInsert):
+    def apply(self, draft: _Draft):
+        super().revert(draft)
+
+    def revert(self, draft: _Draft):
+        super().apply(draft)
+
+
+class Op(ABC):
+    """
+    undoable operation on the message list of a file
+    """
+
+    @abstractmethod
+    def apply(self, messages: list[schema.Message]) -> tuple[list[schema.Message], Optional[int]]:
+        """
+        :param messages: message list, changed in place
+        :return: the message list afterward, which is another list only for `ReplaceAll`,
+        and index of the message to show, None if there is none
+        """
+
+    @abstractmethod
+    def revert(self, messages: list[schema.Message]) -> tuple[list[schema.Message], Optional[int]]:
+        ...
+
+
+class MessageEdit(Op):
+    def __init__(self, index: int, changes: list[Change]):
+        self.index = index
+        self.changes = changes
+
+    def apply(self, messages: list[schema.Message]) -> tuple[list[schema.Message], Optional[int]]:
+        draft = _Draft(messages[self.index])
+        for c in self.changes:
+            c.apply(draft)
+        messages[self.index] = draft.build()
+        return messages, self.index
+
+    def revert(self, messages: list[schema.Message]) -> tuple[list[schema.Message], Optional[int]]:
+        draft = _Draft(messages[self.index])
+        for c in reversed(self.changes):
+            c.revert(draft)
+        messages[self.index] = draft.build()
+        return messages, self.index
+
+
+class MessageInsert(Op):
+    def __init__(self, index: int, message: schema.Message):
+        self.index = index
+        self.message = message
+
+    def apply(self, messages: list[schema.Message]) -> tuple[list[schema.Message], Optional[int]]:
+        messages.insert(self.index, self.message)
+        return messages, self.index
+
+    def revert(self, messages: list[schema.Message]) -> tuple[list[schema.Message], Optional[int]]:
+        messages.pop(self.index)
+        return messages, min(self.index, len(messages) - 1) if len(messages) > 0 else None
+
+
+class MessageRemove(MessageInsert):
+    def apply(self, messages: list[schema.Message]) -> tuple[list[schema.Message], Optional[int]]:
+        return super().revert(messages)
+
+    def revert(self, messages: list[schema.Message]) -> tuple[list[schema.Message], Optional[int]]:
+        return super().apply(messages)
+
+
+class ReplaceAll(Op):
+    """
+    replace the whole message list, e.g. closing a file. both lists are kept by reference rather than copied,
+    they are in the same state as when recorded whenever this op is applied or reverted
+    """
+
+    def __init__(self, old: list[schema.Message], new: list[schema.Message], old_path='', new_path=''):
+        """
+        :param old_path: path of the file `old` belongs to
+        :param new_path: path of the file `new` belongs to
+        """
+        self.old = old
+        self.new = new
+        self.old_path = old_path
+        self.new_path = new_path
+
+    def apply(self, messages: list[schema.Message]) -> tuple[list[schema.Message], Optional[int]]:
+        return self.new, 0 if len(self.new) > 0 else None
+
+    def revert(self, messages: list[schema.Message]) -> tuple[list[schema.Message], Optional[int]]:
+        return self.old, 0 if len(self.old) > 0 else None
+
+
+class Batch(Op):
+    """
+    ops which are undone and redone together
+    """
+
+    def __init__(self, ops: list[Op]):
+        self.ops = ops
+
+    def apply(self, messages: list[schema.Message]) -> tuple[list[schema.Message], Optional[int]]:
+        index = None
+        for op in self.ops:
+            messages, index = op.apply(messages)
+        return messages, index
+
+    def revert(self, messages: list[schema.Message]) -> tuple[list[schema.Message], Optional[int]]:
+        index = None
+        for op in reversed(self.ops):
+            messages, index = op.revert(messages)
+        return messages, index
+
+
+def _same_content(a: Union[schema.TextContent, schema.ImageContent],
+                  b: Union[schema.TextContent, schema.ImageContent]) -> bool:
+    return a is b or (type(a) is type(b) and a == b)
+
+
+def diff_message(index: int, old: schema.Message, new: schema.Message) -> Optional[MessageEdit]:
+    """
+    record the changes from `old` to `new`, only the changed fields, content and text ranges are kept
+    :param index: index of the message
+    :param old: message before the edit
+    :param new: message after the edit
+    :return: edit op, None if nothing changed
+    """
+    changes: list[Change] = []
+    for field in ('role', 'name', 'timestamp'):
+        if getattr(old, field) != getattr(new, field):
+            changes.append(FieldChange(field, getattr(old, field), getattr(new, field)))
+
+    a, b = _Draft(old), _Draft(new)
+    if a.is_str != b.is_str:
+        # the content list is edited in list form, the form is switched around it
+        if a.is_str:
+            changes.append(FieldChange('is_str', True, False))
+        form_change = FieldChange('is_str', False, True) if b.is_str else None
+    else:
+        form_change = None
+
+    prefix = 0
+    while prefix < min(len(a.content), len(b.content)) and _same_content(a.content[prefix], b.content[prefix]):
+        prefix += 1
+    suffix = 0
+    while (suffix < min(len(a.content), len(b.content)) - prefix and
+           _same_content(a.content[len(a.content) - 1 - suffix], b.content[len(b.content) - 1 - suffix])):
+        suffix += 1
+    removed = a.content[prefix:len(a.content) - suffix]
+    inserted = b.content[prefix:len(b.content) - suffix]
+    if (len(removed) == 1 and len(inserted) == 1 and isinstance(removed[0], schema.TextContent) and
+            isinstance(inserted[0], schema.TextContent)):
+        changes.append(TextEdit(prefix, *diff_text(removed[0].text, inserted[0].text)))
+    else:
+        changes.extend(ContentDelete(prefix, c) for c in removed)
+        changes.extend(ContentInsert(prefix + i, c) for i, c in enumerate(inserted))
+
+    if form_change is not None:
+        changes.append(form_change)
+    return MessageEdit(index, changes) if len(changes) > 0 else None
+
+
+class UndoStack:
+    """
+    undo and redo history of ops, memory grows with the size of the edits, not the size of the file
+    """
+
+    def __init__(self, max_depth: int = 1000):
+        """
+        :param max_depth: oldest ops are dropped beyond this many
+        """
+        self._undo: deque[Op] = deque(maxlen=max_depth)
+        self._redo: list[Op] = []
+
+    def push(self, op: Op):
+        """
+        record an op which has already been applied, the redo history is dropped
+        """
+        self._undo.append(op)
+        self._redo.clear()
+
+    def can_undo(self) -> bool:
+        return len(self._undo) > 0
+
+    def can_redo(self) -> bool:
+        return len(self._redo) > 0
+
+    def undo(self, messages: list[schema.Message]) -> Optional[tuple[Op, list[schema.Message], Optional[int]]]:
+        """
+        :param messages: current message list
+        :return: undone op, message list afterward and index of the message to show, None if nothing to undo
+        """
+        if len(self._undo) == 0:
+            return None
+        op = self._undo.pop()
+        messages, index = op.revert(messages)
+        self._redo.append(op)
+        return op, messages, index
+
+    def redo(self, messages: list[schema.Message]) -> Optional[tuple[Op, list[schema.Message], Optional[int]]]:
+        """
+        :param messages: current message list
+        :return: redone op, message list afterward and index of the message to show, None if nothing to redo
+        """
+        if len(self._redo) == 0:
+            return None
+        op = self._redo.pop()
+        messages, index = op.apply(messages)
+        self._undo.append(op)
+        return op, messages, index
+
+    def clear(self):
+        self._undo.clear()
+        self._redo.clear()